@@ -0,0 +1,132 @@
+#!/usr/bin/python
+# Copyright 2015 Neuhold Markus and Kleinsasser Mario
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+sys.path.insert(0, "..")
+import hashlib
+import json
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+from common.helper import crypto
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class LegacyCodec(object):
+    """JSON, AES-CBC and base64 as text frame, understood by every peer
+    """
+    name = "aes-cbc-json"
+    binary = False
+
+    def encode(self, data):
+        return crypto.encode(json.dumps(data).encode('utf-8'))
+
+    def decode(self, payload):
+        return json.loads(crypto.decode(payload).decode('utf-8'))
+
+
+class GcmCodec(object):
+    """AES-GCM authenticated payload as binary frame
+
+    Frame layout: nonce (12 bytes) + ciphertext + tag (16 bytes), the
+    AES-256 key is the sha256 of the configured key.
+    """
+    binary = True
+
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+        self.rawkey = None
+        self.key = None
+
+    def getkey(self):
+        rawkey = crypto.getkey()
+        if rawkey != self.rawkey:
+            self.key = hashlib.sha256(rawkey).digest()
+            self.rawkey = rawkey
+        return self.key
+
+    def encode(self, data):
+        nonce = get_random_bytes(12)
+        cipher = AES.new(self.getkey(), AES.MODE_GCM, nonce=nonce)
+        ciphertext, tag = cipher.encrypt_and_digest(self.dumps(data))
+        return nonce + ciphertext + tag
+
+    def decode(self, payload):
+        payload = bytes(payload)
+        cipher = AES.new(self.getkey(), AES.MODE_GCM, nonce=payload[:12])
+        # raises ValueError if the frame was tampered with
+        raw = cipher.decrypt_and_verify(payload[12:-16], payload[-16:])
+        return self.loads(raw)
+
+
+legacy = LegacyCodec()
+
+# supported codecs, most preferred first
+codecs = []
+if msgpack is not None:
+    codecs.append(GcmCodec("aes-gcm-msgpack",
+                           lambda data: msgpack.packb(data, use_bin_type=True),
+                           lambda raw: msgpack.unpackb(raw, raw=False)))
+codecs.append(GcmCodec("aes-gcm-json",
+                       lambda data: json.dumps(data).encode('utf-8'),
+                       lambda raw: json.loads(raw.decode('utf-8'))))
+codecs.append(legacy)
+
+
+def names():
+    return [c.name for c in codecs]
+
+
+def getcodec(name):
+    for c in codecs:
+        if c.name == name:
+            return c
+    return legacy
+
+
+def negotiate(offered):
+    """Pick our most preferred codec the peer offered, legacy if the
+    peer did not offer any (old PID)
+    """
+    if not offered:
+        return legacy
+    for c in codecs:
+        if c.name in offered:
+            return c
+    return legacy
+
+
+def sendframe(ws, data):
+    """Send data over a websocket using the codec negotiated for it
+    """
+    c = getattr(ws, 'codec', legacy)
+    ws.send(c.encode(data), binary=c.binary)
+
+
+def readframe(ws, msg):
+    """Decode a received websocket message, binary frames carry the
+    negotiated codec, text frames are always legacy
+    """
+    if msg.is_binary:
+        c = getattr(ws, 'codec', legacy)
+        if not c.binary:
+            raise ValueError("Binary frame without negotiated codec")
+        return c.decode(msg.data)
+    return legacy.decode(str(msg))
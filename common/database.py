@@ -21,68 +21,275 @@ from datetime import datetime
 from datetime import timedelta
 import pytz
 import sqlite3
+import time
 import uuid
+from queue import Queue, Empty
 
 from common import config
 from common import error
 from common import smsgwglobals
+from common.smscounter import SmsCounter
 import threading
 
 smsdblock = threading.Lock()
+managerlock = threading.Lock()
+manager = None
+writebehind = None
+counter = None
+
+
+class ConnectionManager(object):
+    """Process wide connection handling for the SMS database - SQLite3
+
+    One writer connection is shared by every Database object and has to
+    be used under smsdblock. Readers get their own connection per thread
+    which is opened on first use and reused afterwards. With the WAL
+    journal readers do not block the writer and vice versa, therefore
+    they do not take smsdblock at all.
+
+    Attributes:
+        dbname -- absolut path to the SQLite database file
+        journalmode -- SQLite journal_mode (WAL, DELETE, ...)
+        synchronous -- SQLite synchronous (OFF, NORMAL, FULL, EXTRA)
+        cachesize -- SQLite cache_size (negative values are KiB)
+        mmapsize -- SQLite mmap_size in bytes
+        busytimeout -- milliseconds to wait for a locked database
+    """
+    dbname = None
+    writer = None
+
+    # Constructor
+    def __init__(self, dbname, journalmode='WAL', synchronous='NORMAL',
+                 cachesize=-16000, mmapsize=268435456, busytimeout=5000):
+        self.dbname = dbname
+        self.journalmode = journalmode.upper()
+        self.synchronous = synchronous.upper()
+        self.cachesize = int(cachesize)
+        self.mmapsize = int(mmapsize)
+        self.busytimeout = int(busytimeout)
+
+        if self.journalmode not in ('WAL', 'DELETE', 'TRUNCATE',
+                                    'PERSIST', 'MEMORY'):
+            raise error.ConfigError("Invalid journalmode '" +
+                                    journalmode + "' in [db]!", None)
+        if self.synchronous not in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+            raise error.ConfigError("Invalid synchronous '" +
+                                    synchronous + "' in [db]!", None)
+
+        self.local = threading.local()
+        smsgwglobals.dblogger.debug("SQLite: Connecting to database...")
+        self.writer = self.connect()
+
+        # journal_mode is persistent, setting it once is enough
+        mode = self.writer.execute("PRAGMA journal_mode = " +
+                                   self.journalmode).fetchone()[0]
+        smsgwglobals.dblogger.info("SQLite: journal_mode is %s", mode)
+
+    # Connect to Database
+    def connect(self):
+        try:
+            con = sqlite3.connect(self.dbname, check_same_thread=False,
+                                  timeout=self.busytimeout / 1000)
+            # change row-factory to get
+            con.row_factory = sqlite3.Row
+            con.execute("PRAGMA busy_timeout = " + str(self.busytimeout))
+            con.execute("PRAGMA synchronous = " + self.synchronous)
+            con.execute("PRAGMA cache_size = " + str(self.cachesize))
+            con.execute("PRAGMA mmap_size = " + str(self.mmapsize))
+        except Exception as e:
+            smsgwglobals.dblogger.critical("SQLite: Unable to connect! " +
+                                           "[EXCEPTION]:%s", e)
+            raise error.DatabaseError('Connection problem!', e)
+        return con
+
+    # Return the reader connection of the calling thread
+    def reader(self):
+        con = getattr(self.local, 'con', None)
+        if con is None:
+            smsgwglobals.dblogger.debug("SQLite: Opening reader " +
+                                        "connection for thread " +
+                                        threading.current_thread().name)
+            con = self.connect()
+            self.local.con = con
+        return con
+
 
 class Database(object):
     """Base class for Database handling - SQLite3
 
+    All Database objects share one process wide ConnectionManager,
+    the configuration is read and the schema is created only once.
+
     Attributes:
         configfile -- path to configuration file
         to read [db] section from.
 
                      [db]
                      dbname = n0r1sk_smsgateway
+                     journalmode = WAL
+                     synchronous = NORMAL
+                     cachesize = -16000
+                     mmapsize = 268435456
+                     busytimeout = 5000
+                     writebehind = On | Off
+                     writebehindinterval = 50 (ms)
+                     writebehindrows = 500
                      loglevel = CRITICAL | ERROR | WARNING | INFO | DEBUG
                      logdirectory = absolut path to log directory
                      fallback is local \log directory
                      logfile = database.log
                      """
-    __smsconfig = None
     __path = path.abspath(path.join(path.dirname(__file__),
                                     path.pardir))
+    __manager = None
     __con = None
-    __cur = None
+
+    insertsmsquery = ("INSERT INTO sms " +
+                      "(smsid, modemid, imsi, targetnr, content, priority, " +
+                      "appid, sourceip, xforwardedfor, smsintime, " +
+                      "status, statustime, campaignid) " +
+                      "VALUES (:smsid, :modemid, :imsi, :targetnr, :content, " +
+                      ":priority, :appid, :sourceip, :xforwardedfor, " +
+                      ":smsintime, :status, :statustime, :campaignid)" +
+                      "ON CONFLICT(smsid) DO UPDATE SET " +
+                      "modemid=excluded.modemid, imsi=excluded.imsi, " +
+                      "statustime=excluded.statustime, status=excluded.status")
+
+    # schema migrations (version, description, queries), append only!
+    migrations = [
+        (1, "indexes for imsi counters, date and stats queries",
+         ["CREATE INDEX IF NOT EXISTS sms_imsi_statustime " +
+          "ON sms (imsi, statustime, status)",
+          "CREATE INDEX IF NOT EXISTS sms_smsintime " +
+          "ON sms (smsintime)",
+          "CREATE INDEX IF NOT EXISTS sms_status_statustime " +
+          "ON sms (status, statustime)",
+          "ANALYZE"]),
+        (2, "campaigns holding content and source of bulk sms once",
+         ["CREATE TABLE IF NOT EXISTS campaigns (" +
+          "campaignid TEXT PRIMARY KEY, " +
+          "content TEXT, " +
+          "appid TEXT, " +
+          "sourceip TEXT, " +
+          "xforwardedfor TEXT, " +
+          "created TIMESTAMP)",
+          "ALTER TABLE sms ADD COLUMN campaignid TEXT",
+          "CREATE INDEX IF NOT EXISTS sms_campaignid " +
+          "ON sms (campaignid)"]),
+    ]
+
+    # sms columns, content and source come from the campaign if the
+    # sms row does not carry them itself
+    selectsmsquery = ("SELECT " +
+                      "sms.smsid, " +
+                      "sms.modemid, " +
+                      "sms.imsi, " +
+                      "sms.targetnr, " +
+                      "COALESCE(sms.content, campaigns.content) AS content, " +
+                      "sms.priority, " +
+                      "COALESCE(sms.appid, campaigns.appid) AS appid, " +
+                      "COALESCE(sms.sourceip, campaigns.sourceip) AS sourceip, " +
+                      "COALESCE(sms.xforwardedfor, campaigns.xforwardedfor) " +
+                      "AS xforwardedfor, " +
+                      "sms.smsintime, " +
+                      "sms.status, " +
+                      "sms.statustime, " +
+                      "sms.campaignid " +
+                      "FROM sms LEFT JOIN campaigns " +
+                      "ON campaigns.campaignid = sms.campaignid ")
+
+    # sms writes take named parameters, count_sms reads them by name
+    updatesmsquery = ("UPDATE sms SET " +
+                      "modemid = :modemid, " +
+                      "imsi = :imsi, " +
+                      "targetnr = :targetnr, " +
+                      "content = CASE WHEN campaignid IS NOT NULL AND " +
+                      "content IS NULL THEN NULL ELSE :content END, " +
+                      "priority = :priority, " +
+                      "appid = CASE WHEN campaignid IS NOT NULL AND " +
+                      "appid IS NULL THEN NULL ELSE :appid END, " +
+                      "sourceip = CASE WHEN campaignid IS NOT NULL AND " +
+                      "sourceip IS NULL THEN NULL ELSE :sourceip END, " +
+                      "xforwardedfor = CASE WHEN campaignid IS NOT NULL AND " +
+                      "xforwardedfor IS NULL THEN NULL ELSE :xforwardedfor END, " +
+                      "smsintime = :smsintime, " +
+                      "status = :status, " +
+                      "statustime = :statustime " +
+                      "WHERE smsid = :smsid")
+
+    insertcampaignquery = ("INSERT OR IGNORE INTO campaigns " +
+                           "(campaignid, content, appid, sourceip, " +
+                           "xforwardedfor, created) " +
+                           "VALUES (?, ?, ?, ?, ?, ?)")
 
     # Constructor
     def __init__(self, configfile=(__path + "/conf/smsgw.conf")):
+        global manager
+        if manager is None:
+            with managerlock:
+                if manager is None:
+                    manager = self.create_manager(configfile)
+
+        self.__manager = manager
+        self.__con = manager.writer
+
+    # Setup the process wide ConnectionManager and the schema
+    def create_manager(self, configfile):
         # read SmsConfigs
-        self.__smsconfig = config.SmsConfig(configfile)
-        dbname = self.__smsconfig.getvalue('dbname', 'n0r1sk_smsgateway', 'db')
+        smsconfig = config.SmsConfig(configfile)
+        dbname = smsconfig.getvalue('dbname', 'n0r1sk_smsgateway', 'db')
         dbname = (self.__path + "/common/sqlite/" + dbname + ".sqlite")
         smsgwglobals.dblogger.info("SQLite: Database file used: %s", dbname)
 
         # connect to database
-        smsgwglobals.dblogger.debug("SQLite: Connecting to database...")
-        self.db_connect(dbname)
+        self.__manager = ConnectionManager(
+            dbname,
+            journalmode=smsconfig.getvalue('journalmode', 'WAL', 'db'),
+            synchronous=smsconfig.getvalue('synchronous', 'NORMAL', 'db'),
+            cachesize=smsconfig.getvalue('cachesize', '-16000', 'db'),
+            mmapsize=smsconfig.getvalue('mmapsize', '268435456', 'db'),
+            busytimeout=smsconfig.getvalue('busytimeout', '5000', 'db'))
+        self.__con = self.__manager.writer
 
         # create tables and indexes if not exit
         self.create_table_users()
         self.create_table_sms()
         self.create_table_stats()
 
-    # Destructor (called with "del <Databaseobj>"
-    def __del__(self):
-        # shutting down connecitons to SQLite
-        self.__con.close()
-
-    # Connect to Database
-    def db_connect(self, dbname="db.sqlite"):
-        try:
-            self.__con = sqlite3.connect(dbname, check_same_thread=False)
-            # change row-factory to get
-            self.__con.row_factory = sqlite3.Row
-            self.__cur = self.__con.cursor()
-        except Exception as e:
-            smsgwglobals.dblogger.critical("SQLite: Unable to connect! " +
-                                           "[EXCEPTION]:%s", e)
-            raise error.DatabaseError('Connection problem!', e)
+        # bring the schema to the latest version
+        self.migrate()
+
+        # per imsi counters for today are kept in memory
+        global counter
+        counter = SmsCounter()
+        self.rebuild_counter()
+
+        # start the optional write-behind queue for sms writes
+        global writebehind
+        if smsconfig.getvalue('writebehind', 'Off', 'db') == 'On':
+            writebehind = WriteBehind(
+                smsconfig.getvalue('writebehindinterval', '50', 'db'),
+                smsconfig.getvalue('writebehindrows', '500', 'db'))
+            writebehind.start()
+        return self.__manager
+
+    # Wait till all deferred sms writes are committed
+    def flush(self):
+        if writebehind is not None:
+            writebehind.flush()
+
+    # Commit deferred sms writes and stop the write-behind queue
+    def shutdown(self):
+        global writebehind
+        wb = writebehind
+        writebehind = None
+        if wb is not None:
+            smsgwglobals.dblogger.info("SQLite: Flushing write-behind queue")
+            wb.stop()
+
+    # Reader connection for the calling thread
+    def __reader(self):
+        return self.__manager.reader()
 
     # Create table users
     def create_table_users(self):
@@ -94,7 +301,7 @@ class Database(object):
                  "changed TIMESTAMP)")
         try:
             smsdblock.acquire()
-            self.__cur.execute(query)
+            self.__con.execute(query)
         finally:
             smsdblock.release()
 
@@ -118,7 +325,7 @@ class Database(object):
                  )
         try:
             smsdblock.acquire()
-            self.__cur.execute(query)
+            self.__con.execute(query)
         finally:
             smsdblock.release()
 
@@ -128,10 +335,62 @@ class Database(object):
                  )
         try:
             smsdblock.acquire()
-            self.__cur.execute(query)
+            self.__con.execute(query)
         finally:
             smsdblock.release()
 
+    # Update the in-memory counters after a committed sms write
+    def count_sms(self, params):
+        if counter is None:
+            return
+        counter.apply(params['smsid'], params['imsi'], params['status'],
+                      params['statustime'])
+
+    # Recreate the in-memory counters out of the sms table
+    def rebuild_counter(self):
+        # statustime is UTC, a day in UKRAINE timezone starts before
+        # midnight UTC, so read from yesterday and let the counter filter
+        since = datetime.utcnow().date() - timedelta(1)
+        query = ("SELECT smsid, imsi, status, statustime " +
+                 "FROM sms " +
+                 "WHERE statustime >= ?")
+        try:
+            result = self.__reader().execute(query, [str(since)])
+            counter.rebuild(result)
+        except Exception as e:
+            smsgwglobals.dblogger.critical("SQLite: " + query +
+                                           " failed! [EXCEPTION]:%s", e)
+            raise error.DatabaseError("Unable to rebuild sms counters! ", e)
+
+    # Apply all schema migrations newer than the database version
+    def migrate(self):
+        """Versioned schema changes, the applied version is kept in
+        PRAGMA user_version. Each migration runs in its own transaction.
+        """
+        version = self.__con.execute("PRAGMA user_version").fetchone()[0]
+        for migration in self.migrations:
+            if migration[0] <= version:
+                continue
+            smsgwglobals.dblogger.info("SQLite: Migrating schema to " +
+                                       "version " + str(migration[0]) +
+                                       " - " + migration[1])
+            try:
+                smsdblock.acquire()
+                self.__con.execute("BEGIN")
+                for query in migration[2]:
+                    self.__con.execute(query)
+                self.__con.execute("PRAGMA user_version = " +
+                                   str(int(migration[0])))
+                self.__con.commit()
+            except Exception as e:
+                self.__con.rollback()
+                smsgwglobals.dblogger.critical("SQLite: Migration " +
+                                               str(migration[0]) +
+                                               " failed! [EXCEPTION]:%s", e)
+                raise error.DatabaseError("Unable to migrate schema! ", e)
+            finally:
+                smsdblock.release()
+
     # Create table stats
     def create_table_stats(self):
         smsgwglobals.dblogger.info("SQLite: Create table 'stats'")
@@ -140,7 +399,7 @@ class Database(object):
                  "lasttimestamp TIMESTAMP)")
         try:
             smsdblock.acquire()
-            self.__cur.execute(query)
+            self.__con.execute(query)
         finally:
             smsdblock.release()
 
@@ -159,7 +418,7 @@ class Database(object):
                                         " :intype: " + str(intype) +
                                         " :lasttimestamp: " + str(timestamp)
                                         )
-            self.__cur.execute(query, (intype, timestamp))
+            self.__con.execute(query, (intype, timestamp))
             self.__con.commit()
             smsgwglobals.dblogger.debug("SQLite: Insert done!")
 
@@ -194,7 +453,7 @@ class Database(object):
                                         " :salt-len: " + str(len(salt)) +
                                         " :changed: " + str(changed)
                                         )
-            self.__cur.execute(query, (user, password, salt, changed))
+            self.__con.execute(query, (user, password, salt, changed))
             self.__con.commit()
             smsgwglobals.dblogger.debug("SQLite: Insert done!")
 
@@ -209,7 +468,8 @@ class Database(object):
     def insert_sms(self, modemid='00431234', imsi='1234567890', targetnr='+431234',
                    content='♠♣♥♦Test', priority=1, appid='demo',
                    sourceip='127.0.0.1', xforwardedfor='172.0.0.1',
-                   smsintime=None, status=0, statustime=None, smsid=None):
+                   smsintime=None, status=0, statustime=None, smsid=None,
+                   defer=False):
         """Insert a fresh SMS out of WIS
         Attributes: modemid ... string-countryexitcode+number (0043664123..)
         imsi ... string-no SIM card IMSI
@@ -222,6 +482,7 @@ class Database(object):
         smsintime ... datetime.utcnow()
         status ... int-0 new, ???
         statustime ... datetime.utcnow()
+        defer ... bool-hand the insert to the write-behind queue if enabled
         """
         # check if smsid is empty string or None
         if smsid is None or not smsid:
@@ -233,13 +494,17 @@ class Database(object):
         if statustime is None:
             statustime = now
 
-        query = ("INSERT INTO sms " +
-                 "(smsid, modemid, imsi, targetnr, content, priority, " +
-                 "appid, sourceip, xforwardedfor, smsintime, " +
-                 "status, statustime) " +
-                 "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)" +
-                 "ON CONFLICT(smsid) DO UPDATE SET " +
-                 "modemid=excluded.modemid, imsi=excluded.imsi, statustime=excluded.statustime, status=excluded.status")
+        query = self.insertsmsquery
+        params = {'smsid': smsid, 'modemid': modemid, 'imsi': imsi,
+                  'targetnr': targetnr, 'content': content,
+                  'priority': priority, 'appid': appid,
+                  'sourceip': sourceip, 'xforwardedfor': xforwardedfor,
+                  'smsintime': smsintime, 'status': status,
+                  'statustime': statustime, 'campaignid': None}
+
+        if defer and writebehind is not None:
+            writebehind.put(query, params)
+            return
 
         try:
             smsdblock.acquire()
@@ -257,11 +522,9 @@ class Database(object):
                                         " :status: " + str(status) +
                                         " :statustime: " + str(statustime)
                                         )
-            self.__con.execute(query, (smsid, modemid, imsi, targetnr,
-                                       content, priority,
-                                       appid, sourceip, xforwardedfor,
-                                       smsintime, status, statustime))
+            self.__con.execute(query, params)
             self.__con.commit()
+            self.count_sms(params)
             smsgwglobals.dblogger.debug("SQLite: Insert done!")
 
         except Exception as e:
@@ -271,50 +534,114 @@ class Database(object):
         finally:
             smsdblock.release()
 
+    # Insert a list of sms in one transaction
+    def insert_sms_many(self, smslist=[], campaign=None):
+        """Insert many fresh SMS out of WIS with one commit
+        Attributes: smslist ... list of sms in dictionary structure
+        (see insert_sms, all keys have to be set)
+        campaign ... dictionary with campaignid, content, appid, sourceip
+        and xforwardedfor, values equal to the campaign are stored once
+        in campaigns instead of in every sms row
+        """
+        now = datetime.utcnow()
+        shared = ('content', 'appid', 'sourceip', 'xforwardedfor')
+        params = []
+        for sms in smslist:
+            if not sms.get('smsid'):
+                sms['smsid'] = str(uuid.uuid1())
+            values = dict((k, sms[k]) for k in shared)
+            campaignid = None
+            if campaign is not None:
+                campaignid = campaign['campaignid']
+                for k in shared:
+                    if values[k] == campaign.get(k):
+                        values[k] = None
+            values.update({'smsid': sms['smsid'], 'modemid': sms['modemid'],
+                           'imsi': sms['imsi'], 'targetnr': sms['targetnr'],
+                           'priority': sms['priority'],
+                           'smsintime': sms['smsintime'] or now,
+                           'status': sms['status'],
+                           'statustime': sms['statustime'] or now,
+                           'campaignid': campaignid})
+            params.append(values)
+
+        query = self.insertsmsquery
+        try:
+            smsdblock.acquire()
+            if campaign is not None:
+                self.__con.execute(self.insertcampaignquery,
+                                   (campaign['campaignid'],
+                                    campaign.get('content'),
+                                    campaign.get('appid'),
+                                    campaign.get('sourceip'),
+                                    campaign.get('xforwardedfor'),
+                                    now))
+            self.__con.executemany(query, params)
+            self.__con.commit()
+            for row in params:
+                self.count_sms(row)
+            smsgwglobals.dblogger.debug("SQLite: Insert of " +
+                                        str(len(params)) + " sms done!")
+
+        except Exception as e:
+            self.__con.rollback()
+            smsgwglobals.dblogger.critical("SQLite: " + query +
+                                           " failed! [EXCEPTION]:%s", e)
+            raise error.DatabaseError("Unable to INSERT sms! ", e)
+        finally:
+            smsdblock.release()
+
     # update sms (input is a list)
-    def update_sms(self, smslist=[]):
+    def update_sms(self, smslist=[], defer=False):
         """Updates Sms entries out of a list to reflect the new values
         all columns of sms have to be set!
         Attributes: smslsit ... list of sms in dictionary structure
         (see read_sms)
+        defer ... bool-hand the updates to the write-behind queue if enabled
         """
         smsgwglobals.dblogger.debug("SQLite: Will update "
                                     + str(len(smslist)) + "sms.")
-        # for each sms in the list
+        query = self.updatesmsquery
+        batch = []
         for sms in smslist:
             smsgwglobals.dblogger.debug("SQLite: Update SMS: " + str(sms))
-            query = ("UPDATE sms SET " +
-                     "modemid = ?, " +
-                     "imsi = ?, " +
-                     "targetnr = ?, " +
-                     "content = ?, " +
-                     "priority = ?, " +
-                     "appid = ?, " +
-                     "sourceip = ?, " +
-                     "xforwardedfor = ?, " +
-                     "smsintime = ?, " +
-                     "status = ?, " +
-                     "statustime = ? " +
-                     "WHERE smsid = ?"
-                     )
-            try:
-                smsdblock.acquire()
-                self.__con.execute(query, (sms['modemid'], sms['imsi'], sms['targetnr'],
-                                           sms['content'], sms['priority'],
-                                           sms['appid'], sms['sourceip'],
-                                           sms['xforwardedfor'],
-                                           sms['smsintime'], sms['status'],
-                                           sms['statustime'], sms['smsid']))
-                self.__con.commit()
-                smsgwglobals.dblogger.debug("SQLite: Update for smsid: " +
-                                            str(sms['smsid']) + " done!")
+            batch.append((query, dict((k, sms[k]) for k in
+                                      ('smsid', 'modemid', 'imsi', 'targetnr',
+                                       'content', 'priority', 'appid',
+                                       'sourceip', 'xforwardedfor',
+                                       'smsintime', 'status', 'statustime'))))
+
+        if defer and writebehind is not None:
+            for query, params in batch:
+                writebehind.put(query, params)
+            return
+
+        # all sms of the list are updated in one transaction
+        self.write_sms_batch(batch)
+
+    # Write a batch of (query, params) in one transaction
+    def write_sms_batch(self, batch):
+        """Executes a list of (query, params) tuples in the given order
+        and commits them at once
+        """
+        query = None
+        try:
+            smsdblock.acquire()
+            for query, params in batch:
+                self.__con.execute(query, params)
+            self.__con.commit()
+            for query, params in batch:
+                self.count_sms(params)
+            smsgwglobals.dblogger.debug("SQLite: Batch of " +
+                                        str(len(batch)) + " sms written!")
 
-            except Exception as e:
-                smsgwglobals.dblogger.critical("SQLite: " + query +
-                                               " failed! [EXCEPTION]:%s", e)
-                raise error.DatabaseError("Unable to UPDATE sms! ", e)
-            finally:
-                smsdblock.release()
+        except Exception as e:
+            self.__con.rollback()
+            smsgwglobals.dblogger.critical("SQLite: " + str(query) +
+                                           " failed! [EXCEPTION]:%s", e)
+            raise error.DatabaseError("Unable to write sms batch! ", e)
+        finally:
+            smsdblock.release()
 
     # Merge userlist with userlist out of db
     def merge_users(self, userlist=[]):
@@ -386,6 +713,7 @@ class Database(object):
             result = self.__con.execute(query, [modemid])
             count = result.rowcount
             self.__con.commit()
+            self.rebuild_counter()
 
             smsgwglobals.dblogger.debug("SQLite: " + str(count) +
                                         " sms for modemid: " +
@@ -417,6 +745,10 @@ class Database(object):
             smsdblock.acquire()
             result = self.__con.execute(query, [ts])
             count = result.rowcount
+            # campaigns without any sms left
+            self.__con.execute("DELETE FROM campaigns WHERE NOT EXISTS " +
+                               "(SELECT 1 FROM sms WHERE " +
+                               "sms.campaignid = campaigns.campaignid)")
             self.__con.commit()
 
             smsgwglobals.dblogger.info("SQLite: " + str(count) +
@@ -440,8 +772,7 @@ class Database(object):
                  "FROM stats " +
                  "WHERE type = ?")
         try:
-            smsdblock.acquire()
-            result = self.__cur.execute(query, [intype])
+            result = self.__reader().execute(query, [intype])
         except Exception as e:
             smsgwglobals.dblogger.critical("SQLite: " + query +
                                            " failed! [EXCEPTION]:%s", e)
@@ -452,8 +783,6 @@ class Database(object):
             smsgwglobals.dblogger.debug("SQLite: " + str(len(stats)) +
                                         " user selected.")
             return stats
-        finally:
-            smsdblock.release()
 
     # Read users
     def read_users(self, user=None):
@@ -468,13 +797,11 @@ class Database(object):
                  "FROM users")
         try:
             if user is None:
-                smsdblock.acquire()
-                result = self.__cur.execute(query)
+                result = self.__reader().execute(query)
             else:
                 # user is set
-                smsdblock.acquire()
                 query = query + " WHERE user = ?"
-                result = self.__cur.execute(query, [user])
+                result = self.__reader().execute(query, [user])
         except Exception as e:
             smsgwglobals.dblogger.critical("SQLite: " + query +
                                            " failed! [EXCEPTION]:%s", e)
@@ -485,8 +812,6 @@ class Database(object):
             smsgwglobals.dblogger.debug("SQLite: " + str(len(user)) +
                                         " user selected.")
             return user
-        finally:
-            smsdblock.release()
 
     # Read sms
     def read_sms_date(self, date=None):
@@ -496,30 +821,23 @@ class Database(object):
 
         smsgwglobals.dblogger.debug("SQLite: Read SMS" +
                                     " :date: " + str(date))
-        query = ("SELECT " +
-                 "smsid, " +
-                 "modemid, " +
-                 "imsi, " +
-                 "targetnr, " +
-                 "content, " +
-                 "priority, " +
-                 "appid, " +
-                 "sourceip, " +
-                 "xforwardedfor, " +
-                 "smsintime, " +
-                 "status, " +
-                 "statustime " +
-                 "FROM sms ")
+        query = self.selectsmsquery
+
+        # a trailing % (2015-01-31%) is a prefix match, search it as a
+        # range to be able to use the sms_smsintime index
+        prefix = date[:-1] if date.endswith("%") else None
         try:
-            smsdblock.acquire()
-            query = query + "WHERE smsintime LIKE ?"
-            result = self.__cur.execute(query, [date])
+            if prefix and "%" not in prefix and "_" not in prefix:
+                upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+                query = query + "WHERE smsintime >= ? AND smsintime < ?"
+                result = self.__reader().execute(query, [prefix, upper])
+            else:
+                query = query + "WHERE smsintime LIKE ?"
+                result = self.__reader().execute(query, [date])
         except Exception as e:
             smsgwglobals.dblogger.critical("SQLite: " + query +
                                            " failed! [EXCEPTION]:%s", e)
             raise error.DatabaseError("Unable to SELECT FROM sms! ", e)
-        finally:
-            smsdblock.release()
 
         sms = [dict(row) for row in result]
         smsgwglobals.dblogger.debug("SQLite: " + str(len(sms)) +
@@ -534,48 +852,30 @@ class Database(object):
                                     " :status: " + str(status) +
                                     " :smsid: " + str(smsid)
                                     )
-        query = ("SELECT " +
-                 "smsid, " +
-                 "modemid, " +
-                 "imsi, " +
-                 "targetnr, " +
-                 "content, " +
-                 "priority, " +
-                 "appid, " +
-                 "sourceip, " +
-                 "xforwardedfor, " +
-                 "smsintime, " +
-                 "status, " +
-                 "statustime " +
-                 "FROM sms ")
+        query = self.selectsmsquery
 
         orderby = " ORDER BY priority DESC, smsintime ASC;"
         try:
             if smsid is not None:
-                smsdblock.acquire()
                 query = query + "WHERE smsid = ?" + orderby
-                result = self.__cur.execute(query, [smsid])
+                result = self.__reader().execute(query, [smsid])
             elif modemid is None:
                 if status is None:
-                    smsdblock.acquire()
                     query = query + orderby
-                    result = self.__cur.execute(query)
+                    result = self.__reader().execute(query)
                 else:
                     # status only
-                    smsdblock.acquire()
                     query = query + "WHERE status = ?" + orderby
-                    result = self.__cur.execute(query, [status])
+                    result = self.__reader().execute(query, [status])
             else:
                 if status is None:
                     # modemid only
-                    smsdblock.acquire()
                     query = query + "WHERE modemid = ?" + orderby
-                    result = self.__cur.execute(query, [modemid])
+                    result = self.__reader().execute(query, [modemid])
                 else:
                     # status and modemid
-                    smsdblock.acquire()
                     query = query + "WHERE status = ? AND modemid = ?" + orderby
-                    result = self.__cur.execute(query, (status, modemid))
+                    result = self.__reader().execute(query, (status, modemid))
         except Exception as e:
             smsgwglobals.dblogger.critical("SQLite: " + query +
                                            " failed! [EXCEPTION]:%s", e)
@@ -585,8 +885,6 @@ class Database(object):
             smsgwglobals.dblogger.debug("SQLite: " + str(len(sms)) +
                                         " SMS selected.")
             return sms
-        finally:
-            smsdblock.release()
 
     # Read successfuly sent sms for stats
     def read_sucsmsstats(self, timestamp=None):
@@ -594,34 +892,20 @@ class Database(object):
         smsgwglobals.dblogger.debug("SQLite: Read SMS stats" +
                                     " with :timestamp: gt " + str(timestamp)
                                     )
-        query = ("SELECT " +
-                 "smsid, " +
-                 "modemid, " +
-                 "imsi, " +
-                 "targetnr, " +
-                 "content, " +
-                 "priority, " +
-                 "appid, " +
-                 "sourceip, " +
-                 "xforwardedfor, " +
-                 "smsintime, " +
-                 "status, " +
-                 "statustime " +
-                 "FROM sms " +
+        query = (self.selectsmsquery +
                  "WHERE (status = 4 OR status = 5)"
                  )
         # status 4 or 5 -> successfully send sms
 
         orderby = " ORDER BY statustime ASC;"
         try:
-            smsdblock.acquire()
             if timestamp is None:
                 query = query + orderby
-                result = self.__cur.execute(query)
+                result = self.__reader().execute(query)
             else:
                 # greater than timestamp
                 query = query + "AND statustime > ?" + orderby
-                result = self.__cur.execute(query, [timestamp])
+                result = self.__reader().execute(query, [timestamp])
         except Exception as e:
             smsgwglobals.dblogger.critical("SQLite: " + query +
                                            " failed! [EXCEPTION]:%s", e)
@@ -631,62 +915,22 @@ class Database(object):
             smsgwglobals.dblogger.debug("SQLite: " + str(len(sms)) +
                                         " SMS for stats selected.")
             return sms
-        finally:
-            smsdblock.release()
 
     # Read number of sms sent for last 24h per SIM IMSI in UKRAINE timezone
     def read_sms_count_by_imsi(self, imsi = None, real_sent = False, all_imsi = False):
 
-        utc_timezone = pytz.timezone("UTC")
-        ua_timezone = pytz.timezone("Europe/Kiev")
-
-        today = datetime.utcnow().astimezone(ua_timezone).date()
-        start = datetime(today.year, today.month, today.day, tzinfo=ua_timezone).astimezone(utc_timezone)
-        end = start + timedelta(1)
-
         smsgwglobals.dblogger.debug("SQLite: Read SMS stats" +
                                     " with :imsi: " + str(imsi) +
                                     " for last 24 hours"
                                     )
+        # served from the in-memory counters, see SmsCounter
         if all_imsi:
-            query = ("SELECT imsi, count(*) as sms_count " +
-                     "FROM sms " +
-                     "WHERE statustime BETWEEN ? AND ?"
-                     )
-            # Return already sent sms, not scheduled
-            if real_sent:
-                query = query + " AND status = 1"
-            query = query + " GROUP BY imsi"
+            sms_count = counter.countall(real_sent)
         else:
-            query = ("SELECT count(*) " +
-                 "FROM sms " +
-                 "WHERE imsi = ? " +
-                 "AND statustime BETWEEN ? AND ?"
-                )
-            # Return already sent sms, not scheduled
-            if real_sent:
-                query = query + " AND status = 1"
-
-        try:
-            smsdblock.acquire()
-            if all_imsi:
-                result = self.__cur.execute(query, [ start, end])
-            else:
-                result = self.__cur.execute(query, [ imsi, start, end])
-        except Exception as e:
-            smsgwglobals.dblogger.critical("SQLite: " + query +
-                                           " failed! [EXCEPTION]:%s", e)
-            raise error.DatabaseError("Unable to SELECT sms_count FROM sms! ", e)
-        else:
-            if all_imsi:
-                sms_count = [dict(row) for row in result]
-            else:
-                sms_count = result.fetchone()[0]
-            smsgwglobals.dblogger.debug("SQLite: Sent " + str(sms_count) +
-                                            " SMS for IMSI " + str(imsi) + ".")
-            return sms_count
-        finally:
-            smsdblock.release()
+            sms_count = counter.count(imsi, real_sent)
+        smsgwglobals.dblogger.debug("SQLite: Sent " + str(sms_count) +
+                                    " SMS for IMSI " + str(imsi) + ".")
+        return sms_count
 
     # Read number of sms sent/unsent ()all witghout 24h limit) for last 24h in UKRAINE timezone
     def read_sms_stats(self):
@@ -706,8 +950,7 @@ class Database(object):
                                 " for last 24 hours + Read RESEND SMS stats"
                                 )
         try:
-            smsdblock.acquire()
-            result = self.__cur.execute(query, [ start, end ])
+            result = self.__reader().execute(query, [ start, end ])
         except Exception as e:
             smsgwglobals.dblogger.critical("SQLite: " + query +
                                            " failed! [EXCEPTION]:%s", e)
@@ -717,8 +960,87 @@ class Database(object):
             processed_sms_count = res[0] if res[0] is not None else 0
             unprocessed_sms_count = res[1] if res[1] is not None else 0
             return { "processed_sms": processed_sms_count, "unprocessed_sms": unprocessed_sms_count }
-        finally:
-            smsdblock.release()
+
+class WriteBehind(threading.Thread):
+    """Group commit for sms inserts and updates
+
+    Deferred writes are collected and committed in one transaction as
+    soon as interval milliseconds are over or rows writes are waiting.
+
+    Attributes:
+        interval -- milliseconds to collect writes for one commit
+        rows -- maximum number of writes in one commit
+    """
+    def __init__(self, interval=50, rows=500):
+        super(WriteBehind, self).__init__()
+        self.name = "WriteBehind"
+        self.daemon = True
+        self.interval = int(interval) / 1000
+        self.rows = int(rows)
+        self.queue = Queue()
+        self.e = threading.Event()
+
+    def put(self, query, params):
+        self.queue.put((query, params))
+
+    def flush(self, timeout=None):
+        """Blocks till every write queued before the call is committed
+        """
+        if not self.is_alive():
+            return False
+        done = threading.Event()
+        self.queue.put(done)
+        return done.wait(timeout)
+
+    def run(self):
+        smsgwglobals.dblogger.debug("WRITEBEHIND: starting")
+        while not self.e.is_set() or not self.queue.empty():
+            batch = []
+            flushed = []
+            item = self.queue.get()
+            until = time.monotonic() + self.interval
+            while True:
+                if isinstance(item, threading.Event):
+                    # somebody waits for this write, commit right now
+                    flushed.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.rows:
+                    break
+                timeout = until - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except Empty:
+                    break
+
+            if batch:
+                self.write(batch)
+            for done in flushed:
+                done.set()
+
+        smsgwglobals.dblogger.debug("WRITEBEHIND: stopped")
+
+    def write(self, batch):
+        db = Database()
+        try:
+            db.write_sms_batch(batch)
+        except error.DatabaseError:
+            # do not lose the whole batch because of one bad row
+            for query, params in batch:
+                try:
+                    db.write_sms_batch([(query, params)])
+                except error.DatabaseError as e:
+                    smsgwglobals.dblogger.critical("WRITEBEHIND: dropped " +
+                                                   str(params) +
+                                                   " [EXCEPTION]:%s",
+                                                   e.baseexcepton)
+
+    def stop(self):
+        self.e.set()
+        self.flush()
+
 
 def main():
     db = Database()
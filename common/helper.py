@@ -19,40 +19,65 @@ from os import path
 from common.config import SmsConfig
 
 import base64
-import hashlib
-from Crypto import Random
+import threading
 from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
 
-class GlobalHelper(object):
 
-    @staticmethod
-    def encodeAES(raw):
-        abspath = path.abspath(path.join(path.dirname(__file__), path.pardir))
-        configfile = abspath + '/conf/smsgw.conf'
-        cfg = SmsConfig(configfile)
-        key = cfg.getvalue('key', '7D8FAA235238F8C2').encode('utf-8')
+class CryptoContext(object):
+    """AES-CBC context for the messages between WIS, PIS and PID
 
-        def _pad(s):
-            bs = AES.block_size
-            return s + (bs - len(s) % bs) * chr(bs - len(s) % bs)
+    The key is read from conf/smsgw.conf on first use and kept, a
+    changed key needs a restart. encode/decode work on bytes,
+    the encoded value is base64 of iv + ciphertext.
+    """
 
-        raw = _pad(raw)
-        iv = Random.new().read(AES.block_size)
-        cipher = AES.new(key, AES.MODE_CBC, iv)
-        return base64.b64encode(iv + cipher.encrypt(raw.encode()))
+    def __init__(self, configfile=None):
+        if configfile is None:
+            abspath = path.abspath(path.join(path.dirname(__file__),
+                                             path.pardir))
+            configfile = abspath + '/conf/smsgw.conf'
+        self.configfile = configfile
+        self.lock = threading.Lock()
+        self.key = None
 
-    @staticmethod
-    def decodeAES(enc):
-        abspath = path.abspath(path.join(path.dirname(__file__), path.pardir))
-        configfile = abspath + '/conf/smsgw.conf'
-        cfg = SmsConfig(configfile)
+    def reload(self):
+        cfg = SmsConfig(self.configfile)
         key = cfg.getvalue('key', '7D8FAA235238F8C2').encode('utf-8')
+        with self.lock:
+            self.key = key
+        return key
+
+    def getkey(self):
+        key = self.key
+        if key is None:
+            key = self.reload()
+        return key
 
+    def encode(self, raw):
+        bs = AES.block_size
+        padlen = bs - len(raw) % bs
+        iv = get_random_bytes(bs)
+        cipher = AES.new(self.getkey(), AES.MODE_CBC, iv)
+        return base64.b64encode(iv + cipher.encrypt(raw + bytes([padlen]) * padlen))
+
+    def decode(self, enc):
         enc = base64.b64decode(enc)
         iv = enc[:AES.block_size]
-        cipher = AES.new(key, AES.MODE_CBC, iv)
+        cipher = AES.new(self.getkey(), AES.MODE_CBC, iv)
+        raw = cipher.decrypt(enc[AES.block_size:])
+        return raw[:-raw[-1]]
+
 
-        def _unpad(s):
-            return s[:-ord(s[len(s)-1:])]
+crypto = CryptoContext()
 
-        return _unpad(cipher.decrypt(enc[AES.block_size:])).decode('utf-8')
+
+class GlobalHelper(object):
+
+    @staticmethod
+    def encodeAES(raw):
+        return crypto.encode(raw.encode('utf-8'))
+
+    @staticmethod
+    def decodeAES(enc):
+        return crypto.decode(enc).decode('utf-8')
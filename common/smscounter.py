@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# Copyright 2015 Neuhold Markus and Kleinsasser Mario
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+sys.path.insert(0, "..")
+from datetime import datetime
+import pytz
+import threading
+
+utc_timezone = pytz.timezone("UTC")
+ua_timezone = pytz.timezone("Europe/Kiev")
+
+
+class SmsCounter(object):
+    """In-memory sms counters per (imsi, day, status class)
+
+    Only the current day in UKRAINE timezone is kept. Each counted sms
+    remembers its key, so a status change moves it from one class to
+    the other instead of counting it twice.
+
+    Status classes:
+        sent -- status = 1, the sms was really sent
+        other -- all other status values
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.day = None
+        # (imsi, day, statusclass) -> count
+        self.counts = {}
+        # smsid -> (imsi, day, statusclass) of the sms counted today
+        self.smsen = {}
+
+    @staticmethod
+    def today():
+        return datetime.now(utc_timezone).astimezone(ua_timezone).date()
+
+    @staticmethod
+    def localday(statustime):
+        """Day in UKRAINE timezone of an UTC statustime (datetime or
+        string as stored by SQLite), None if it is not set
+        """
+        if not statustime:
+            return None
+        if isinstance(statustime, str):
+            try:
+                statustime = datetime.strptime(statustime[:19],
+                                               '%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                return None
+        if statustime.tzinfo is None:
+            statustime = utc_timezone.localize(statustime)
+        return statustime.astimezone(ua_timezone).date()
+
+    @staticmethod
+    def statusclass(status):
+        return "sent" if status == 1 else "other"
+
+    # Start a new day if needed, has to be called with lock held
+    def roll(self):
+        today = self.today()
+        if today != self.day:
+            self.day = today
+            self.counts = {}
+            self.smsen = {}
+        return today
+
+    def rebuild(self, rows):
+        """Recreate all counters out of (smsid, imsi, status, statustime)
+        rows
+        """
+        with self.lock:
+            self.day = None
+            self.roll()
+            for row in rows:
+                self.__apply(row[0], row[1], row[2], row[3])
+
+    def apply(self, smsid, imsi, status, statustime):
+        """Count a written sms with its current values
+        """
+        with self.lock:
+            self.roll()
+            self.__apply(smsid, imsi, status, statustime)
+
+    def __apply(self, smsid, imsi, status, statustime):
+        old = self.smsen.pop(smsid, None)
+        if old is not None:
+            self.counts[old] -= 1
+
+        if not imsi or self.localday(statustime) != self.day:
+            return
+
+        key = (imsi, self.day, self.statusclass(status))
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.smsen[smsid] = key
+
+    def count(self, imsi, real_sent=False):
+        with self.lock:
+            today = self.roll()
+            sent = self.counts.get((imsi, today, "sent"), 0)
+            if real_sent:
+                return sent
+            return sent + self.counts.get((imsi, today, "other"), 0)
+
+    def countall(self, real_sent=False):
+        """List of {imsi, sms_count} for all imsi with sms today
+        """
+        with self.lock:
+            today = self.roll()
+            totals = {}
+            for (imsi, day, statusclass), count in self.counts.items():
+                if day != today or count == 0:
+                    continue
+                if real_sent and statusclass != "sent":
+                    continue
+                totals[imsi] = totals.get(imsi, 0) + count
+        return [{"imsi": imsi, "sms_count": count}
+                for imsi, count in totals.items()]
@@ -15,13 +15,11 @@
 
 import threading
 import time
-import json
-import urllib.request
 
 from common import smsgwglobals
 # from common import error
 import pidglobals
-from common.helper import GlobalHelper
+from common import codec
 
 
 class Heartbeat(threading.Thread):
@@ -50,9 +48,7 @@ class Heartbeat(threading.Thread):
             data['action'] = "heartbeat"
             data['status'] = "sent"
 
-            asjson = json.dumps(data)
             smsgwglobals.pidlogger.debug("HEARTBEAT: SENT heartbeat msg: " + str(self.handler))
-            tosend = GlobalHelper.encodeAES(asjson)
 
             try:
                 gammu_object = pidglobals.modemcondict[modem["modemid"]]
@@ -67,7 +63,7 @@ class Heartbeat(threading.Thread):
                 try:
                     # sending heartbeat message to PID
                     # returncodes are handled in PidWsClient.received_message
-                    self.handler.send(tosend)
+                    codec.sendframe(self.handler, data)
                 except Exception as e:
                     # at any error with communication to PID end heartbeat
                     smsgwglobals.pidlogger.warning("HEARTBEAT: ERROR at " +
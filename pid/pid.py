@@ -35,7 +35,7 @@ sys.path.insert(1, str(d))
 import pidglobals
 from common import smsgwglobals
 from common.config import SmsConfig
-from common.helper import GlobalHelper
+from common import codec
 from common.filelogger import FileLogger
 from helper.heartbeat import Heartbeat
 from helper.wrapped import WrappedUSBModem
@@ -56,6 +56,8 @@ class PidWsClient(WebSocketClient):
         data['pidid'] = pidglobals.pidid
         data['modemlist'] = pidglobals.modemlist
         data['pidprotocol'] = pidglobals.pidprotocol
+        # offer our wire codecs, the PIS picks one in the reply
+        data['codecs'] = codec.names()
 
         # if modemlist is not [] register at PIS
         if data['modemlist']:
@@ -63,8 +65,7 @@ class PidWsClient(WebSocketClient):
             smsgwglobals.pidlogger.debug(pidglobals.pidid + ": " +
                                          "Registration data: " +
                                          asjson)
-            tosend = GlobalHelper.encodeAES(asjson)
-            self.send(tosend)
+            codec.sendframe(self, data)
         else:
             # close connection to PIS
             closingreason = "Unable to connect to modem(s)"
@@ -83,12 +84,11 @@ class PidWsClient(WebSocketClient):
         pidglobals.closingcode = code
 
     def received_message(self, msg):
-        plaintext = GlobalHelper.decodeAES(str(msg))
+        data = codec.readframe(self, msg)
 
         smsgwglobals.pidlogger.debug(pidglobals.pidid + ": " +
                                      "Message received: " +
-                                     str(plaintext))
-        data = json.loads(plaintext)
+                                     str(data))
 
         if data['action'] == "sendsms":
             tosend = Modem.sendsms(data)
@@ -97,9 +97,8 @@ class PidWsClient(WebSocketClient):
             smsgwglobals.pidlogger.debug(pidglobals.pidid + ": " +
                                          "Message delivery status: " +
                                          str(plaintext))
-            message = GlobalHelper.encodeAES(plaintext)
             # reply sms-status to PIS
-            self.send(message)
+            codec.sendframe(self, tosend)
             #Make sure answer will be delivered before shutdown (if will happen)
             sleep(0.1)
 
@@ -126,6 +125,11 @@ class PidWsClient(WebSocketClient):
 
         if data['action'] == "register":
             if data['status'] == "registered":
+                # switch to the codec chosen by PIS, legacy for old PIS
+                self.codec = codec.getcodec(data.get('codec'))
+                smsgwglobals.pidlogger.debug(pidglobals.pidid + ": " +
+                                             "Using wire codec " +
+                                             self.codec.name)
                 # Start Heartbeat to connected PID
                 hb = Heartbeat(data['modemlist'], self)
                 hb.daemon = True
@@ -222,6 +226,10 @@ class Modem(object):
             modem["balance_regex"] = carrier_cfg.get('balance_regex')
             modem["sms_limit"] = carrier_cfg.get('sms_limit') if carrier_cfg.get('sms_limit') else 0
             modem["check_sim_status"] = carrier_cfg.get('check_sim_status')
+            # sending rate for the carrier, WIS defaults are used if unset
+            modem["sms_per_minute"] = carrier_cfg.get('sms_per_minute')
+            modem["sms_burst"] = carrier_cfg.get('sms_burst')
+            modem["sms_jitter"] = carrier_cfg.get('sms_jitter')
 
             if modem["check_sim_status"] == False:
                 modem['sim_blocked'] = "Check Skipped"
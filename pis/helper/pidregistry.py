@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# Copyright 2015 Neuhold Markus and Kleinsasser Mario
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+
+class PidRegistry(object):
+    """Connected PIDs with hash indexes
+
+    clients ... address -> {'handler', 'pidid', 'modemlist'}
+    modems ... modemid -> address
+    smsen ... (address, smsid) -> {'status', 'status_code', 'event'}
+
+    clients and modems are one copy-on-write snapshot: register and
+    close build a new one under the lock, readers never lock. smsen
+    is split into shards with an own lock each.
+    """
+
+    shards = 16
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshot = ({}, {})
+        self.smslocks = [threading.Lock() for i in range(self.shards)]
+        self.smsen = [{} for i in range(self.shards)]
+
+    def addclient(self, address, handler):
+        with self.lock:
+            clients, modems = self.snapshot
+            clients = dict(clients)
+            clients[address] = {'handler': handler,
+                                'pidid': None,
+                                'modemlist': []}
+            self.snapshot = (clients, modems)
+
+    def addclientinfo(self, address, pidid, modemlist=None):
+        with self.lock:
+            clients, modems = self.snapshot
+            client = dict(clients[address])
+            client['pidid'] = pidid
+            clients = dict(clients)
+            clients[address] = client
+            if modemlist:
+                client['modemlist'] = list(modemlist)
+                modems = dict(modems)
+                for modem in modemlist:
+                    modems[modem['modemid']] = address
+            self.snapshot = (clients, modems)
+
+    def delclient(self, address=None):
+        with self.lock:
+            if address is None:
+                self.snapshot = ({}, {})
+                return
+            clients, modems = self.snapshot
+            if address not in clients:
+                return
+            clients = dict(clients)
+            client = clients.pop(address)
+            modems = dict(modems)
+            for modem in client['modemlist']:
+                # only if the modem did not register from elsewhere
+                if modems.get(modem['modemid']) == address:
+                    del modems[modem['modemid']]
+            self.snapshot = (clients, modems)
+
+    def gethandler(self, address):
+        return self.snapshot[0][address]['handler']
+
+    def getaddress(self, modemid):
+        return self.snapshot[1].get(modemid)
+
+    def getmodemlist(self, address=None):
+        clients = self.snapshot[0]
+        if address is not None:
+            client = clients.get(address)
+            return list(client['modemlist']) if client else []
+        modemlist = []
+        for client in clients.values():
+            modemlist.extend(client['modemlist'])
+        return modemlist
+
+    def shard(self, smsid):
+        return hash(smsid) % self.shards
+
+    def addsms(self, address, smsid, status, status_code):
+        i = self.shard(smsid)
+        with self.smslocks[i]:
+            self.smsen[i][(address, smsid)] = {'status': status,
+                                               'status_code': status_code,
+                                               'event': threading.Event()}
+
+    def getsms(self, address, smsid):
+        i = self.shard(smsid)
+        with self.smslocks[i]:
+            return self.smsen[i].get((address, smsid))
+
+    def setsms(self, address, smsid, status, status_code):
+        i = self.shard(smsid)
+        with self.smslocks[i]:
+            sms = self.smsen[i].get((address, smsid))
+            if sms is None:
+                return False
+            sms['status'] = status
+            sms['status_code'] = status_code
+        sms['event'].set()
+        return True
+
+    def popsms(self, address, smsid):
+        i = self.shard(smsid)
+        with self.smslocks[i]:
+            return self.smsen[i].pop((address, smsid), None)
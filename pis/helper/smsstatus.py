@@ -0,0 +1,123 @@
+#!/usr/bin/python
+# Copyright 2015 Neuhold Markus and Kleinsasser Mario
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from queue import Queue
+
+import pisglobals
+from common import smsgwglobals
+from helper.topid import PID
+from helper.towis import WIS
+
+# smsid -> {address, statusurl, timer} of sms accepted for WIS
+pending = {}
+pendinglock = threading.Lock()
+# (statusurl, data, attempt) to post back to WIS
+statusqueue = Queue()
+sender = None
+
+
+class SmsStatus(object):
+    """Keeps the sms accepted from WIS with a statusurl and posts their
+    status back to WIS once PID reported it, or 1000 after maxwaitpid
+    """
+    @staticmethod
+    def add(address, smsid, statusurl):
+        SmsStatus.start()
+        timer = threading.Timer(pisglobals.maxwaitpid, SmsStatus.timeout,
+                                [smsid])
+        timer.daemon = True
+        with pendinglock:
+            pending[smsid] = {'address': str(address),
+                              'statusurl': statusurl,
+                              'timer': timer}
+        timer.start()
+
+    @staticmethod
+    def complete(smsid, status_code):
+        with pendinglock:
+            sms = pending.pop(smsid, None)
+        if sms is None:
+            return False
+
+        sms['timer'].cancel()
+        PID.removeclientsms(sms['address'], smsid)
+        statusqueue.put((sms['statusurl'], {'smsid': smsid,
+                                            'status_code': status_code}, 0))
+        return True
+
+    @staticmethod
+    def cancel(smsid):
+        # sms not sent to PID, WIS gets no status for it
+        with pendinglock:
+            sms = pending.pop(smsid, None)
+        if sms is not None:
+            sms['timer'].cancel()
+            PID.removeclientsms(sms['address'], smsid)
+
+    @staticmethod
+    def timeout(smsid):
+        if SmsStatus.complete(smsid, 1000):
+            smsgwglobals.pislogger.warning("/sendsms: maxwaitpid " +
+                                           "of " + str(pisglobals.maxwaitpid) +
+                                           " seconds reached for " + smsid)
+
+    @staticmethod
+    def start():
+        global sender
+        with pendinglock:
+            if sender is None:
+                sender = threading.Thread(target=SmsStatus.run,
+                                          name="SmsStatus")
+                sender.daemon = True
+                sender.start()
+
+    @staticmethod
+    def statusurls(statusurl):
+        # the WIS which sent the sms first, then the configured ones
+        urls = [statusurl]
+        for wisurl in pisglobals.wisurllist:
+            url = wisurl['url'] + "/api/smsstatus"
+            if url not in urls:
+                urls.append(url)
+        return urls
+
+    @staticmethod
+    def run():
+        while True:
+            statusurl, data, attempt = statusqueue.get()
+            urls = SmsStatus.statusurls(statusurl)
+            retries = max(pisglobals.retrywisurl, 1)
+            httpcode = WIS.request_smsstatus(urls[attempt // retries], data)
+            if httpcode == 200:
+                continue
+
+            if httpcode == 404:
+                # this WIS does not know the sms, try the next one
+                attempt = (attempt // retries + 1) * retries
+            else:
+                attempt += 1
+            if attempt // retries >= len(urls):
+                smsgwglobals.pislogger.warning("/sendsms: unable to post " +
+                                               "status of " + data['smsid'] +
+                                               " to any WIS")
+                continue
+
+            # retry later without holding up the other status
+            wait = pisglobals.retrywait * 2 ** (attempt % retries)
+            timer = threading.Timer(wait, statusqueue.put,
+                                    [(statusurl, data, attempt)])
+            timer.daemon = True
+            timer.start()
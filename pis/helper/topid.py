@@ -13,22 +13,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import pisglobals
 # from common import error
 from common import smsgwglobals
-import json
-from common.helper import GlobalHelper
+from common import codec
+from helper.pidregistry import PidRegistry
+
+# all connected PIDs of this PIS
+registry = PidRegistry()
 
 
 class PID(object):
-    """Class used to store SocketHandlers into pisglobals.knownpids
+    """Class used to store SocketHandlers into the PID registry
        and for doing communication with the PID
     """
     @staticmethod
     def addclient(address, handler):
         address = str(address)
-        pisglobals.knownpids[address] = {'handler': handler,
-                                         'smslist': []}
+        registry.addclient(address, handler)
         smsgwglobals.pislogger.info("/ws: " + address +
                                     " - connected.")
 
@@ -36,49 +37,52 @@ class PID(object):
     def addclientinfo(address, pidid=None, modemlist=None):
         address = str(address)
         if pidid:
-            pisglobals.knownpids[address]['pidid'] = pidid
+            registry.addclientinfo(address, pidid, modemlist)
             smsgwglobals.pislogger.debug("/ws: " + address +
                                          "- adding pidid: " + pidid)
             if modemlist:
-                pisglobals.knownpids[address]['modemlist'] = modemlist
                 smsgwglobals.pislogger.debug("/ws: " + address +
                                              "- adding modemlist: "
                                              + str(modemlist))
 
     @staticmethod
     def addclientsms(address, smsid, status="SENTTOMODEM", status_code = 0):
-        # add tupple wisid/smsid to form list of forwarded to PID
-        address = str(address)
-        element = {'smsid': smsid,
-                   'status': status,
-                   'status_code': status_code}
-        pisglobals.knownpids[address]['smslist'].append(element)
+        # add smsid to the sms forwarded to PID, the event is set
+        # as soon as PID reports the status
+        registry.addsms(str(address), smsid, status, status_code)
 
     @staticmethod
     def getclientsmsstatus(address, smsid):
-        """ Set or get clientsmsstatus
+        """ Get clientsmsstatus, (False, None) if the sms is unknown
         """
-        address = str(address)
-        for sms in pisglobals.knownpids[address]['smslist']:
-            if sms['smsid'] == smsid:
-                # Get status
-                smsgwglobals.pislogger.debug("PID: SMSstatus " +
-                                             sms['status'] +
-                                             ", SMSStatusCode " +
-                                             str(sms['status_code']) +
-                                             " for SMS with id " +
-                                             smsid +
-                                             " found.")
-                return sms['status'], sms['status_code']
+        sms = registry.getsms(str(address), smsid)
+        if sms is not None:
+            smsgwglobals.pislogger.debug("PID: SMSstatus " +
+                                         sms['status'] +
+                                         ", SMSStatusCode " +
+                                         str(sms['status_code']) +
+                                         " for SMS with id " +
+                                         smsid +
+                                         " found.")
+            return sms['status'], sms['status_code']
 
         smsgwglobals.pislogger.debug("PID: No matching SMS for id " +
                                      smsid + "found!")
-        return False
+        return False, None
+
+    @staticmethod
+    def waitclientsmsstatus(address, smsid, timeout):
+        """ Wait up to timeout seconds for the status reported by PID
+        """
+        sms = registry.getsms(str(address), smsid)
+        if sms is None:
+            return False, None
+        sms['event'].wait(timeout)
+        return sms['status'], sms['status_code']
 
     @staticmethod
     def setclientsmsstatus(address, smsid, status, status_code):
-        if PID.removeclientsms(address, smsid):
-            PID.addclientsms(address, smsid, status, status_code)
+        if registry.setsms(str(address), smsid, status, status_code):
             smsgwglobals.pislogger.debug("PID: SMSstatus " +
                                          status +
                                          ", SMSStatusCode " +
@@ -90,13 +94,7 @@ class PID(object):
     @staticmethod
     def removeclientsms(address, smsid):
         # remove smsid from list of sms for PID
-        straddress = str(address)
-        status, status_code = PID.getclientsmsstatus(address, smsid)
-        if status:
-            element = {'smsid': smsid,
-                       'status': status,
-                       'status_code': status_code}
-            pisglobals.knownpids[straddress]['smslist'].remove(element)
+        if registry.popsms(str(address), smsid) is not None:
             smsgwglobals.pislogger.debug("PID: Removed SMS with ID " +
                                          smsid +
                                          " from smslist.")
@@ -107,52 +105,37 @@ class PID(object):
     @staticmethod
     def delclient(address=None, code=None, reason=None):
         if address is None:
-            # if no PID is connected init pisglobals
-            pisglobals.knownpids = None
+            # if no PID is connected forget all of them
+            registry.delclient()
 
         else:
             # else remove only clients from one PID
             address = str(address)
-            try:
-                del pisglobals.knownpids[address]["modemlist"]
-                del pisglobals.knownpids[address]["handler"]
-            except:
-                pass
+            registry.delclient(address)
             smsgwglobals.pislogger.debug("/ws: " + address +
                                          " - disconnected. Code: " +
                                          str(code) + " Reason: " + str(reason))
 
     @staticmethod
     def getclientmodemlist(address=None):
-        modemlist = []
-
         if address is None:
-            for address in pisglobals.knownpids:
-                if 'modemlist' in pisglobals.knownpids[address]:
-                    modems = pisglobals.knownpids[address]['modemlist']
-                    for modem in modems:
-                        modemlist.append(modem)
-
-            smsgwglobals.pislogger.debug("PID: Full Modemlist " +
-                                         str(modemlist) +
-                                         " returned.")
+            modemlist = registry.getmodemlist()
+            smsgwglobals.pislogger.debug("PID: Full Modemlist of " +
+                                         str(len(modemlist)) +
+                                         " modems returned.")
         else:
             address = str(address)
+            modemlist = registry.getmodemlist(address)
             smsgwglobals.pislogger.debug("PID: Modemlist for " +
                                          address +
                                          " returned.")
-            if 'modemlist' in pisglobals.knownpids[address]:
-                modemlist = pisglobals.knownpids[address]['modemlist']
 
         return modemlist
 
     @staticmethod
     def sendtopid(address, data):
-        asjson = json.dumps(data)
-        tosend = GlobalHelper.encodeAES(asjson)
-
         client = PID.getclienthandler(address)
-        client.send(tosend)
+        codec.sendframe(client, data)
         smsgwglobals.pislogger.debug("/ws: Sending data to " +
                                      str(address) + " - " +
                                      str(data))
@@ -162,23 +145,16 @@ class PID(object):
         smsgwglobals.pislogger.debug("PID: Handler for " +
                                      address +
                                      " returned.")
-        return pisglobals.knownpids[address]['handler']
+        return registry.gethandler(address)
 
     @staticmethod
     def getclientaddress(modemid):
-        smsgwglobals.pislogger.debug("PID: Query address for modemid: " +
-                                     modemid)
-        smsgwglobals.pislogger.debug("PID: getclientaddress has kownpids = " +
-                                     str(pisglobals.knownpids))
-        for address in pisglobals.knownpids:
-            client = pisglobals.knownpids[address]
-            modems = client["modemlist"] if "modemlist" in client else {}
-            for modem in modems:
-                if modem is not None and modem['modemid'] == modemid:
-                    smsgwglobals.pislogger.debug("PID: Address " +
-                                                 address +
-                                                 " returned.")
-                    return address
-
-        smsgwglobals.pislogger.debug("PID: No matching client found!")
+        address = registry.getaddress(modemid)
+        if address is not None:
+            smsgwglobals.pislogger.debug("PID: Address " + address +
+                                         " returned for modemid: " + modemid)
+            return address
+
+        smsgwglobals.pislogger.debug("PID: No matching client found for " +
+                                     "modemid: " + modemid)
         return False
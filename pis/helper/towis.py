@@ -74,6 +74,9 @@ class WIS(object):
                 data['account_balance'] = modem['account_balance']
                 data['sms_limit'] = modem['sms_limit']
                 data['sim_blocked'] = modem['sim_blocked']
+                data['sms_per_minute'] = modem.get('sms_per_minute')
+                data['sms_burst'] = modem.get('sms_burst')
+                data['sms_jitter'] = modem.get('sms_jitter')
 
                 httpcode = WIS.loopwis(data)
 
@@ -165,3 +168,31 @@ class WIS(object):
                                      str(httpcode))
 
         return httpcode
+
+    @staticmethod
+    def request_smsstatus(statusurl, data):
+        asjson = json.dumps(data)
+        smsgwglobals.pislogger.debug("/sendsms: Call WIS " + statusurl +
+                                     ": " + str(asjson))
+
+        tosend = GlobalHelper.encodeAES(asjson)
+
+        request = urllib.request.Request(statusurl)
+        request.add_header("Content-Type",
+                           "application/json;charset=utf-8")
+        try:
+            f = urllib.request.urlopen(request, tosend, timeout=5)
+            httpcode = f.getcode()
+        except urllib.error.HTTPError as e:
+            httpcode = e.code
+            smsgwglobals.pislogger.warning("/sendsms: WIS smsstatus error: " +
+                                           str(e))
+        except Exception as e:
+            httpcode = 500  # Internal Server error
+            smsgwglobals.pislogger.warning("/sendsms: WIS smsstatus error: " +
+                                           str(e))
+
+        smsgwglobals.pislogger.debug("/sendsms: WIS smsstatus response: " +
+                                     str(httpcode))
+
+        return httpcode
@@ -17,11 +17,8 @@ import cherrypy
 import json
 from os import path
 import sys
-import time
 import uuid
 import socket
-from datetime import datetime
-from datetime import timedelta
 from ws4py.server.cherrypyserver import WebSocketTool, WebSocketPlugin
 from ws4py.websocket import WebSocket
 
@@ -32,10 +29,12 @@ sys.path.insert(1, str(d))
 import pisglobals
 from helper.towis import WIS
 from helper.topid import PID
+from helper.smsstatus import SmsStatus
 # from common import error
 from common import smsgwglobals
 from common.config import SmsConfig
 from common.helper import GlobalHelper
+from common import codec
 from common.filelogger import FileLogger
 
 
@@ -61,6 +60,8 @@ class Root(object):
             data = json.loads(plaintext)
             # adding action switch for message to PID
             data['action'] = "sendsms"
+            # WIS wants the status posted back instead of waiting
+            statusurl = data.pop('statusurl', None)
             smsgwglobals.pislogger.debug("/sendsms: dictionary: " +
                                          str(data))
 
@@ -73,28 +74,33 @@ class Root(object):
         try:
             address = PID.getclientaddress(data['modemid'])
 
-            if address:
-                # sending SMS to Pid
-                PID.sendtopid(address, data)
+            if address and statusurl:
+                # accept at once, status is posted to WIS later
+                SmsStatus.add(address, data['smsid'], statusurl)
+                PID.addclientsms(address, data['smsid'])
+                try:
+                    PID.sendtopid(address, data)
+                except Exception:
+                    # not sent, WIS gets the 500 but no status later
+                    SmsStatus.cancel(data['smsid'])
+                    raise
+                cherrypy.response.status = 202
+                return "202"
+
+            elif address:
+                # sending SMS to Pid, known before PID can answer
                 PID.addclientsms(address, data['smsid'])
+                PID.sendtopid(address, data)
 
-                # Poll PIDsmstatus every 0.20 second till maxwait
+                # Wait for the status, process_msg wakes us up at once
                 maxwaitpid = pisglobals.maxwaitpid
-                now = datetime.utcnow()
-                until = now + timedelta(seconds=maxwaitpid)
-
-                while now < until:
-                    status, status_code = PID.getclientsmsstatus(address, data['smsid'])
+                status, status_code = PID.waitclientsmsstatus(address, data['smsid'], maxwaitpid)
 
-                    if status == 'SUCCESS' or status == "ERROR":
-                        cherrypy.response.status = 200
-                        cherrypy.response.body = status_code
-                        PID.removeclientsms(address, data['smsid'])
-                        return str(status_code)
-
-                    # wait for next run
-                    time.sleep(0.50)
-                    now = datetime.utcnow()
+                if status == 'SUCCESS' or status == "ERROR":
+                    cherrypy.response.status = 200
+                    cherrypy.response.body = status_code
+                    PID.removeclientsms(address, data['smsid'])
+                    return str(status_code)
 
                 # maxwaitpid reached so raise an error
                 smsgwglobals.pislogger.warning("/sendsms: maxwaitpid " +
@@ -186,9 +192,7 @@ class WebSocketHandler(WebSocket):
         # smsgwglobals.pislogger.debug("/ws: " + str(self.peer_address) +
         #                              " - Got message: '" + str(msg) + "'")
         try:
-            plaintext = GlobalHelper.decodeAES(str(msg))
-            # smsgwglobals.pislogger.debug("/ws: plaintext: " + plaintext)
-            data = json.loads(plaintext)
+            data = codec.readframe(self, msg)
             smsgwglobals.pislogger.debug("/ws: message-dictionary: " +
                                          str(data))
 
@@ -220,10 +224,15 @@ class WebSocketHandler(WebSocket):
                 data['status'] = "registered"
                 # replace modemlist to have routingids in it
                 data['modemlist'] = modemlist
+                # pick a wire codec out of the ones offered by PID,
+                # old PIDs do not offer any and stay on legacy
+                wirecodec = codec.negotiate(data.get('codecs'))
+                data['codec'] = wirecodec.name
                 smsgwglobals.pislogger.debug("/ws: reply registered - " +
                                              str(data))
-                # respond registation status
+                # respond registation status, still with legacy codec
                 PID.sendtopid(str(self.peer_address), data)
+                self.codec = wirecodec
             else:
                 closingreason = 'Unable to register to any WIS!'
                 # tell PID to close and retry initialisation
@@ -235,6 +244,9 @@ class WebSocketHandler(WebSocket):
                                    data['smsid'],
                                    data['status'],
                                    data['status_code'])
+            # post it to WIS if the sms was accepted with a statusurl
+            if data['status'] == 'SUCCESS' or data['status'] == "ERROR":
+                SmsStatus.complete(data['smsid'], data['status_code'])
 
         if data['action'] == "heartbeat":
             # forward heartbeat to WIS
@@ -16,7 +16,6 @@
 pisprotocol = 'V1.0'
 pisid = None
 pisurl = None
-knownpids = {}
 wisurllist = None
 activewisurl = None
 retrywisurl = None
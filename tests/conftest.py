@@ -0,0 +1,22 @@
+# Copyright 2015 Neuhold Markus and Kleinsasser Mario
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+from os import path
+
+# common is imported from the root, the wis modules as application
+# like the daemons do it
+root = path.abspath(path.join(path.dirname(__file__), path.pardir))
+sys.path.insert(0, root)
+sys.path.insert(0, path.join(root, "wis"))
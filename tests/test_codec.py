@@ -0,0 +1,88 @@
+# Copyright 2015 Neuhold Markus and Kleinsasser Mario
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from common import codec
+
+data = {"action": "sendsms", "smsid": "1", "content": "♠♣♥♦ Test", "priority": 1}
+
+
+class Message(object):
+    def __init__(self, payload, binary):
+        self.data = payload
+        self.is_binary = binary
+
+    def __str__(self):
+        return self.data.decode('utf-8')
+
+
+class Socket(object):
+    def __init__(self, c=None):
+        if c is not None:
+            self.codec = c
+        self.sent = []
+
+    def send(self, payload, binary=False):
+        self.sent.append(Message(payload, binary))
+
+
+@pytest.mark.parametrize("c", codec.codecs, ids=codec.names())
+def test_roundtrip(c):
+    assert c.decode(c.encode(data)) == data
+
+
+def test_gcm_frame_layout():
+    c = codec.getcodec("aes-gcm-json")
+    first = c.encode(data)
+    # nonce + ciphertext + tag, a new nonce every time
+    assert len(first) == 12 + len(c.dumps(data)) + 16
+    assert c.encode(data)[:12] != first[:12]
+
+
+def test_gcm_tampered_frame_is_rejected():
+    c = codec.getcodec("aes-gcm-json")
+    frame = bytearray(c.encode(data))
+    frame[20] ^= 1
+    with pytest.raises(ValueError):
+        c.decode(frame)
+
+
+def test_negotiate():
+    assert codec.negotiate(None) is codec.legacy
+    assert codec.negotiate([]) is codec.legacy
+    assert codec.negotiate(["unknown"]) is codec.legacy
+    assert codec.negotiate(["aes-cbc-json", "aes-gcm-json"]).name == "aes-gcm-json"
+    assert codec.getcodec("unknown") is codec.legacy
+
+
+def test_frames_over_negotiated_codec():
+    ws = Socket(codec.getcodec("aes-gcm-json"))
+    codec.sendframe(ws, data)
+    assert ws.sent[0].is_binary
+    assert codec.readframe(ws, ws.sent[0]) == data
+
+
+def test_text_frames_are_legacy():
+    ws = Socket()
+    codec.sendframe(ws, data)
+    assert not ws.sent[0].is_binary
+    assert codec.readframe(ws, ws.sent[0]) == data
+
+
+def test_binary_frame_without_codec_is_rejected():
+    ws = Socket()
+    frame = codec.getcodec("aes-gcm-json").encode(data)
+    with pytest.raises(ValueError):
+        codec.readframe(ws, Message(frame, True))
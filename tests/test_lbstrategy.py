@@ -0,0 +1,83 @@
+# Copyright 2015 Neuhold Markus and Kleinsasser Mario
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from application import lbstrategy
+from application import wisglobals
+from application.smsqueue import SmsQueue
+
+
+def route(routingid, sms_count=0, lbfactor=1):
+    return {"routingid": routingid, "sms_count": sms_count, "lbfactor": lbfactor}
+
+
+def test_leastload_by_lbfactor_last_on_tie():
+    strategy = lbstrategy.LeastLoad()
+    routes = [route("a", 10), route("b", 10, lbfactor=2), route("c", 5)]
+    assert strategy.select(routes, {})["routingid"] == "c"
+    routes = [route("a", 4), route("b", 4)]
+    assert strategy.select(routes, {})["routingid"] == "b"
+
+
+def test_wrr_is_smooth_and_weighted():
+    strategy = lbstrategy.WeightedRoundRobin()
+    routes = [route("a", lbfactor=3), route("b", lbfactor=1)]
+    picks = [strategy.select(routes, {})["routingid"] for i in range(8)]
+    assert picks == ["a", "a", "b", "a", "a", "a", "b", "a"]
+    strategy.forget("a")
+    assert "a" not in strategy.current
+
+
+def test_outstanding_counts_queue_pending_and_picks():
+    strategy = lbstrategy.LeastOutstanding()
+    queue = SmsQueue()
+    queue.put("sms")
+    wisglobals.watchdogRouteThreadQueue["a"] = queue
+    try:
+        routes = [route("a"), route("b"), route("c")]
+        strategy.sent("b")
+        strategy.sent("b")
+        assert strategy.select(routes, {"c": 2})["routingid"] == "a"
+        strategy.done("b")
+        strategy.done("b")
+        assert strategy.select(routes, {"a": 1})["routingid"] == "b"
+        # done without sent does not go below zero
+        strategy.done("c")
+        assert strategy.pending == {}
+    finally:
+        wisglobals.watchdogRouteThreadQueue.pop("a")
+
+
+def test_ewma_prefers_fast_and_successful_routes():
+    strategy = lbstrategy.Ewma()
+    routes = [route("slow"), route("fast"), route("failing")]
+    for i in range(5):
+        strategy.observe("slow", 4.0, True)
+        strategy.observe("fast", 0.5, True)
+        strategy.observe("failing", 0.5, False)
+    assert strategy.select(routes, {})["routingid"] == "fast"
+    # unknown routes count as average
+    strategy.forget("fast")
+    assert strategy.select([route("slow"), route("new")], {})["routingid"] == "new"
+
+
+def test_selector_counts_picks_per_reservation():
+    select = lbstrategy.selector("outstanding")
+    routes = [route("x1"), route("x2")]
+    picks = [select(routes)["routingid"] for i in range(4)]
+    assert sorted(picks) == ["x1", "x1", "x2", "x2"]
+    assert select([route("only")])["routingid"] == "only"
+
+
+def test_unknown_strategy_is_leastload():
+    assert lbstrategy.getstrategy("nope") is lbstrategy.strategies["leastload"]
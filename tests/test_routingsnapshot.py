@@ -0,0 +1,77 @@
+# Copyright 2015 Neuhold Markus and Kleinsasser Mario
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from application.routingsnapshot import RoutingSnapshot
+
+
+def route(routingid, regex, modemid=None, obsolete=0, sms_count=0,
+          sms_limit=100, sim_blocked="No"):
+    return {"routingid": routingid, "modemid": modemid or routingid,
+            "regex": regex, "obsolete": obsolete, "sms_count": sms_count,
+            "sms_limit": sms_limit, "sim_blocked": sim_blocked}
+
+
+def ids(routes):
+    return [r["routingid"] for r in routes]
+
+
+def test_literal_prefixes_are_looked_up():
+    snapshot = RoutingSnapshot([route("a", "^38067"),
+                                route("b", "^\\+38050"),
+                                route("c", "^380")])
+    assert set(snapshot.prefixes) == {"38067", "+38050", "380"}
+    assert snapshot.patterns == []
+    assert ids(snapshot.eligible("380671234567")) == ["a", "c"]
+    assert ids(snapshot.eligible("+380501234567")) == ["b"]
+    assert ids(snapshot.eligible("380501234567")) == ["c"]
+
+
+def test_regex_and_prefix_keep_table_order():
+    snapshot = RoutingSnapshot([route("a", "^(38067|38096)"),
+                                route("b", "^38067"),
+                                route("c", "^(38067|38096)")])
+    # routes sharing a regex are compiled once
+    assert len(snapshot.patterns) == 1
+    assert ids(snapshot.eligible("380671234567")) == ["a", "b", "c"]
+    assert ids(snapshot.eligible("380961234567")) == ["a", "c"]
+
+
+def test_fallback_only_without_match():
+    snapshot = RoutingSnapshot([route("f", "^38067|fallback"),
+                                route("a", "^38050")])
+    assert ids(snapshot.eligible("380501234567")) == ["a"]
+    assert ids(snapshot.eligible("380671234567")) == ["f"]
+    assert ids(snapshot.eligible("491234567890")) == ["f"]
+
+
+def test_unusable_routes_are_not_eligible():
+    snapshot = RoutingSnapshot([route("a", "^380", obsolete=1),
+                                route("b", "^380", sms_count=100),
+                                route("c", "^380", sim_blocked="Yes"),
+                                route("d", "^380")])
+    assert ids(snapshot.eligible("380671234567")) == ["d"]
+
+
+def test_invalid_regex_is_skipped():
+    snapshot = RoutingSnapshot([route("a", "^(380"), route("b", "^380")])
+    assert ids(snapshot.eligible("380671234567")) == ["b"]
+    assert ids(snapshot.eligible("491234567890")) == []
+
+
+def test_raise_sms_count_per_modem():
+    snapshot = RoutingSnapshot([route("a", "^380", modemid="m1", sms_limit=2),
+                                route("b", "^380", modemid="m2", sms_limit=2)])
+    snapshot.raise_sms_count("m1", 2)
+    assert snapshot.bymodem["m1"][0]["sms_count"] == 2
+    assert ids(snapshot.eligible("380671234567")) == ["b"]
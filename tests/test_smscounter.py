@@ -0,0 +1,79 @@
+# Copyright 2015 Neuhold Markus and Kleinsasser Mario
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from datetime import datetime, timedelta
+
+from common.smscounter import SmsCounter
+
+
+def test_counts_per_imsi_and_status():
+    counter = SmsCounter()
+    now = datetime.utcnow()
+    counter.apply("a", "imsi1", 0, now)
+    counter.apply("b", "imsi1", 1, now)
+    counter.apply("c", "imsi2", 1, now)
+    assert counter.count("imsi1") == 2
+    assert counter.count("imsi1", real_sent=True) == 1
+    assert counter.count("imsi2") == 1
+    assert counter.count("imsi3") == 0
+
+
+def test_status_change_moves_the_sms():
+    counter = SmsCounter()
+    now = datetime.utcnow()
+    counter.apply("a", "imsi1", 0, now)
+    counter.apply("a", "imsi1", 1, now)
+    assert counter.count("imsi1") == 1
+    assert counter.count("imsi1", real_sent=True) == 1
+
+
+def test_other_days_and_missing_imsi_are_not_counted():
+    counter = SmsCounter()
+    counter.apply("a", "imsi1", 1, datetime.utcnow() - timedelta(days=3))
+    counter.apply("b", "", 1, datetime.utcnow())
+    counter.apply("c", "imsi1", 1, None)
+    assert counter.count("imsi1") == 0
+    assert counter.countall() == []
+
+
+def test_statustime_as_stored_string():
+    counter = SmsCounter()
+    counter.apply("a", "imsi1", 1, str(datetime.utcnow()))
+    assert counter.count("imsi1", real_sent=True) == 1
+
+
+def test_new_day_starts_empty():
+    counter = SmsCounter()
+    now = datetime.utcnow()
+    counter.apply("a", "imsi1", 1, now)
+    tomorrow = SmsCounter.today() + timedelta(days=1)
+    counter.today = lambda: tomorrow
+    assert counter.count("imsi1") == 0
+    # an sms of the former day does not move into the new one
+    counter.apply("a", "imsi1", 1, now)
+    assert counter.count("imsi1") == 0
+
+
+def test_rebuild_and_countall():
+    counter = SmsCounter()
+    now = datetime.utcnow()
+    counter.apply("old", "imsi9", 1, now)
+    counter.rebuild([("a", "imsi1", 1, now),
+                     ("b", "imsi1", 0, now),
+                     ("c", "imsi2", 1, now)])
+    assert counter.count("imsi9") == 0
+    assert sorted(counter.countall(), key=lambda c: c["imsi"]) == \
+        [{"imsi": "imsi1", "sms_count": 2}, {"imsi": "imsi2", "sms_count": 1}]
+    assert sorted(counter.countall(real_sent=True), key=lambda c: c["imsi"]) == \
+        [{"imsi": "imsi1", "sms_count": 1}, {"imsi": "imsi2", "sms_count": 1}]
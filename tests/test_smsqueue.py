@@ -0,0 +1,57 @@
+# Copyright 2015 Neuhold Markus and Kleinsasser Mario
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from application.smsqueue import SmsQueue
+
+
+def drain(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+def test_highest_priority_first_fifo_within():
+    queue = SmsQueue()
+    queue.put("low1", priority=0)
+    queue.put("mid1")
+    queue.put("high1", priority=5)
+    queue.put("mid2", priority=1)
+    queue.put_nowait("high2", priority=5)
+    queue.put("low2", priority=0)
+    assert drain(queue) == ["high1", "high2", "mid1", "mid2", "low1", "low2"]
+
+
+def test_depths():
+    queue = SmsQueue()
+    queue.put("a", priority=2)
+    queue.put("b", priority=2)
+    queue.put("c")
+    assert queue.depths() == {2: 2, 1: 1}
+    queue.get_nowait()
+    queue.get_nowait()
+    assert queue.depths() == {1: 1}
+    assert queue.qsize() == 1
+
+
+def test_priority_is_clamped_or_defaulted():
+    assert SmsQueue.clamp("3") == 3
+    assert SmsQueue.clamp(99) == SmsQueue.highest
+    assert SmsQueue.clamp(-1) == SmsQueue.lowest
+    queue = SmsQueue()
+    queue.put("bad", priority="high")
+    queue.put("none", priority=None)
+    queue.put("top", priority=99)
+    assert queue.depths() == {1: 2, SmsQueue.highest: 1}
+    assert drain(queue) == ["top", "bad", "none"]
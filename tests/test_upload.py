@@ -0,0 +1,46 @@
+# Copyright 2015 Neuhold Markus and Kleinsasser Mario
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+
+from application import upload
+
+
+def body(text):
+    return io.BytesIO(text.encode('utf-8'))
+
+
+def test_ndjson_rows():
+    rows = list(upload.readrows(body('380671234567\n'
+                                     '\n'
+                                     '{"Mobile": "380501234567", "Content": "Hi ♠"}\n'
+                                     '{"mobile": \n'),
+                                None))
+    assert rows == [{"mobile": "380671234567"},
+                    {"mobile": "380501234567", "content": "Hi ♠"},
+                    {"error": ":line 4 is not valid JSON"}]
+
+
+def test_csv_rows():
+    rows = list(upload.readrows(body('Mobile, content ,appid\n'
+                                     '380671234567, Hello ,app1\n'
+                                     '380501234567\n'),
+                                'text/csv; charset=utf-8'))
+    assert rows == [{"mobile": "380671234567", "content": "Hello", "appid": "app1"},
+                    {"mobile": "380501234567"}]
+
+
+def test_chunks():
+    assert list(upload.chunks(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(upload.chunks([], 2)) == []
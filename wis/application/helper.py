@@ -25,12 +25,18 @@ from common import error
 from common import smsgwglobals
 from application import apperror
 from application import wisglobals
+from application import lbstrategy
+from application import peerclient
 import uuid
-import urllib.request
 import json
-import re
-import socket
+import requests
 import pytz
+import threading
+import time
+
+# wisurl -> {'version', 'fullsync'} of the last routing sent to a peer
+routingpeers = {}
+routingpeerslock = threading.Lock()
 
 
 class Helper(object):
@@ -42,14 +48,14 @@ class Helper(object):
             sms.smsdict["smsid"] = str(uuid.uuid1())
 
         sms.smsdict["smsintime"] = datetime.utcnow()
-        possibleroutes = []
 
         if Helper.allowed_time():
+            selectedroute = None
             try:
-                routes = wisglobals.rdb.read_routing()
+                snapshot = wisglobals.rdb.read_snapshot()
 
                 # check if we have routes
-                if routes is None or len(routes) == 0:
+                if len(snapshot.routes) == 0:
                     sms.smsdict["status"] = 104
                     sms.smsdict["modemid"] = "NoRoutes"
                     sms.smsdict["imsi"] = ""
@@ -62,32 +68,13 @@ class Helper(object):
                 #if sms.smsdict.get("modemid") and sms.smsdict.get("imsi"):
                 #    wisglobals.rdb.decrease_sms_count(sms.smsdict["modemid"])
 
-                # try to match routes, get possible routes
-                for route in routes:
-                    match = re.search(route["regex"], sms.smsdict["targetnr"])
-                    if match is not None:
-                        possibleroutes.append(route)
-
-                # if no matches than take default modem
-                if possibleroutes is None or len(possibleroutes) == 0:
-                    for route in routes:
-                        match = re.search(route["regex"], "fallback")
-                        if match is not None:
-                            possibleroutes.append(route)
-
-                # if there are obsolete routes remove them from possible
-                possibleroutes[:] = [d for d in possibleroutes if d['obsolete'] < 1]
-
-                # if there routes with sms_count == sms_limit remove them from possible
-                possibleroutes[:] = [d for d in possibleroutes if d['sms_count'] < d['sms_limit']]
-
-                # if there routes with blocked sim cards remove them from possible
-                possibleroutes[:] = [d for d in possibleroutes if d['sim_blocked'] != "Yes"]
-
-                smsgwglobals.wislogger.debug("HELPER: receiverouting %s", str(possibleroutes))
+                # select the route and count the sms on it in one step
+                selectedroute, snapshot = wisglobals.rdb.reserve_route(sms.smsdict["targetnr"],
+                                                                       lbstrategy.selector())
+                smsgwglobals.wislogger.debug("HELPER: receiverouting %s", str(selectedroute))
 
                 # if we still have no possible routes raise error
-                if possibleroutes is None or len(possibleroutes) == 0:
+                if selectedroute is None:
                     sms.smsdict["status"] = 104
                     sms.smsdict["modemid"] = "NoPossibleRoutes"
                     sms.smsdict["imsi"] = ""
@@ -96,36 +83,16 @@ class Helper(object):
                     smsgwglobals.wislogger.debug("POSSIBLE ROUTES empty!")
                     raise apperror.NoRoutesFoundError()
 
-                # decide modemid to send sms
-                # if only one possibility just set it and save it
-                if len(possibleroutes) == 1:
-                    sms.smsdict["modemid"] = possibleroutes[0]["modemid"]
-                    sms.smsdict["imsi"] = possibleroutes[0]["imsi"]
-                    sms.smsdict["status"] = 0
-                    sms.smsdict["statustime"] = datetime.utcnow()
-                    wisglobals.rdb.raise_sms_count(sms.smsdict["modemid"])
-                    sms.writetodb()
-                    smsgwglobals.wislogger.debug("HELPER: receiverouting One route found!")
-                    smsgwglobals.wislogger.debug("HELPER: receiverouting %s ", possibleroutes)
-                else:
-                    smsgwglobals.wislogger.debug("More than one route found!")
-                    lbcount = 1000000
-                    selectedroute = None
-                    for route in possibleroutes:
-                        if route["sms_count"] / route["lbfactor"] <= lbcount:
-                            lbcount = route["sms_count"] / route["lbfactor"]
-                            selectedroute = route
-
-                    smsgwglobals.wislogger.debug("HELPER: One route selected!")
-                    smsgwglobals.wislogger.debug("HELPER: receiverouting %s ", possibleroutes)
-                    sms.smsdict["modemid"] = selectedroute["modemid"]
-                    sms.smsdict["imsi"] = selectedroute["imsi"]
-                    sms.smsdict["status"] = 0
-                    sms.smsdict["statustime"] = datetime.utcnow()
-                    wisglobals.rdb.raise_sms_count(sms.smsdict["modemid"])
-                    sms.writetodb()
+                sms.smsdict["modemid"] = selectedroute["modemid"]
+                sms.smsdict["imsi"] = selectedroute["imsi"]
+                sms.smsdict["status"] = 0
+                sms.smsdict["statustime"] = datetime.utcnow()
+                sms.writetodb()
             except error.DatabaseError as e:
                 smsgwglobals.wislogger.debug(e.message)
+                # not stored, give the reserved route back
+                if selectedroute is not None:
+                    wisglobals.rdb.release_routes({selectedroute["modemid"]: 1})
         else:
             sms.smsdict["status"] = 105
             sms.smsdict["modemid"] = "NotAllowedTimeFrame"
@@ -135,6 +102,92 @@ class Helper(object):
             smsgwglobals.wislogger.debug("Not allowed timeframe to process SMS!")
             raise apperror.NotAllowedTimeFrame()
 
+    @staticmethod
+    def selectroute(possibleroutes):
+        # decided by the [wis] lbstrategy, see lbstrategy.py
+        return lbstrategy.selector()(possibleroutes)
+
+    @staticmethod
+    def campaign(campaignid, sms):
+        """Campaign dictionary with the shared values of an Smstransfer
+        """
+        return {"campaignid": campaignid,
+                "content": sms.smsdict["content"],
+                "appid": sms.smsdict["appid"],
+                "sourceip": sms.smsdict["sourceip"],
+                "xforwardedfor": sms.smsdict["xforwardedfor"]}
+
+    @staticmethod
+    def processsms_bulk(smslist, campaign=None):
+        """Routes a list of Smstransfer objects against one snapshot of the
+        routing table and writes all of them in one transaction.
+        campaign is the optional dictionary (see Helper.campaign) the sms
+        content and source are stored with once.
+        Returns the list of routed sms (status 0) to be queued, each
+        carrying its route and the snapshot version (see Watchdog.process).
+        """
+        now = datetime.utcnow()
+        routed = []
+        sms_counts = {}
+
+        if Helper.allowed_time():
+            snapshot = wisglobals.rdb.read_snapshot()
+            routes = snapshot.routes
+            if len(routes) > 0:
+                # select and count the routes of the whole list at once
+                selected, snapshot = wisglobals.rdb.reserve_routes(
+                    [sms.smsdict["targetnr"] for sms in smslist], lbstrategy.selector())
+        else:
+            routes = None
+            smsgwglobals.wislogger.debug("Not allowed timeframe to process SMS!")
+
+        for i, sms in enumerate(smslist):
+            sms.smsdict["smsintime"] = now
+            sms.smsdict["statustime"] = now
+
+            if routes is None:
+                sms.smsdict["status"] = 105
+                sms.smsdict["modemid"] = "NotAllowedTimeFrame"
+                sms.smsdict["imsi"] = ""
+                continue
+
+            if len(routes) == 0:
+                sms.smsdict["status"] = 104
+                sms.smsdict["modemid"] = "NoRoutes"
+                sms.smsdict["imsi"] = ""
+                continue
+
+            selectedroute = selected[i]
+            if selectedroute is None:
+                sms.smsdict["status"] = 104
+                sms.smsdict["modemid"] = "NoPossibleRoutes"
+                sms.smsdict["imsi"] = ""
+                continue
+
+            modemid = selectedroute["modemid"]
+            sms_counts[modemid] = sms_counts.get(modemid, 0) + 1
+
+            sms.smsdict["modemid"] = modemid
+            sms.smsdict["imsi"] = selectedroute["imsi"]
+            sms.smsdict["status"] = 0
+            sms.route = snapshot.bymodem[modemid]
+            sms.routingversion = snapshot.version
+            routed.append(sms)
+
+        try:
+            db = Database()
+            db.insert_sms_many([sms.smsdict for sms in smslist], campaign)
+        except error.DatabaseError as e:
+            smsgwglobals.wislogger.debug(e.message)
+            # nothing stored, give the reserved routes back
+            wisglobals.rdb.release_routes(sms_counts)
+            return []
+
+        smsgwglobals.wislogger.debug("HELPER: processsms_bulk " +
+                                     str(len(routed)) + " of " +
+                                     str(len(smslist)) + " sms routed")
+        return routed
+
     @staticmethod
     def allowed_time():
         allowed = False
@@ -169,53 +222,37 @@ class Helper(object):
         smsgwglobals.wislogger.debug("HELPER: Routes to check " +
                                      str(len(peers)))
 
+        # all peers and all wis of the routing table are
+        # checked at once, a round takes as long as the
+        # slowest of them
+        urls = []
         for p in peers:
-            try:
-                if "url" not in p:
-                    continue
-                smsgwglobals.wislogger.debug(p["url"] +
-                                             "/")
-                request = \
-                    urllib.request.Request(p["url"] +
-                                           "/")
-                f = urllib.request.urlopen(request, timeout=5)
-                smsgwglobals.wislogger.debug(f.getcode())
-
-                if f.getcode() != 200:
-                    smsgwglobals.wislogger.debug("XXX WIS DELETE")
-                    wisglobals.rdb.delete_routing_wisurl(
-                        p["url"])
-            except urllib.error.URLError as e:
-                smsgwglobals.wislogger.debug(e)
-                wisglobals.rdb.delete_routing_wisurl(
-                    p["url"])
-            except socket.timeout as e:
-                smsgwglobals.wislogger.debug(e)
-                smsgwglobals.wislogger.debug("HELPER: ceckrouting socket connection timeout")
-
-        # check routing table entries
-        routes = wisglobals.rdb.read_routing()
-        for route in routes:
-            try:
-                smsgwglobals.wislogger.debug(route["wisurl"] +
-                                             "/")
-                request = \
-                    urllib.request.Request(route["wisurl"] +
-                                           "/")
-                f = urllib.request.urlopen(request, timeout=5)
-                smsgwglobals.wislogger.debug(f.getcode())
-
-                if f.getcode() != 200:
-                    smsgwglobals.wislogger.debug("XXX WIS DELETE")
-                    wisglobals.rdb.delete_routing_wisurl(
-                        p["url"])
-            except urllib.error.URLError as e:
-                smsgwglobals.wislogger.debug(e)
-                wisglobals.rdb.delete_routing_wisurl(
-                    p["url"])
-            except socket.timeout as e:
+            if "url" in p and p["url"] not in urls:
+                urls.append(p["url"])
+        for route in wisglobals.rdb.read_routing():
+            if route["wisurl"] not in urls:
+                urls.append(route["wisurl"])
+
+        def check(url):
+            smsgwglobals.wislogger.debug(url + "/")
+            return peerclient.get(url + "/", timeout=5).status_code
+
+        for url, status, e in peerclient.fanout(check, urls, 6):
+            # only a slow answer keeps the routes, not reaching the
+            # peer at all deletes them
+            if isinstance(e, requests.exceptions.Timeout) and \
+                    not isinstance(e, requests.exceptions.ConnectTimeout):
                 smsgwglobals.wislogger.debug(e)
                 smsgwglobals.wislogger.debug("HELPER: checkrouting socket connection timeout")
+                continue
+            if e is not None:
+                smsgwglobals.wislogger.debug(e)
+            else:
+                smsgwglobals.wislogger.debug(status)
+                if status == 200:
+                    continue
+            smsgwglobals.wislogger.debug("XXX WIS DELETE")
+            wisglobals.rdb.delete_routing_wisurl(url)
 
     @staticmethod
     def receiverouting():
@@ -230,6 +267,7 @@ class Helper(object):
         peers = json.loads(peersjson)
 
         # read all active routes
+        routes = []
         try:
             routes = wisglobals.rdb.read_routing()
         except error.DatabaseError as e:
@@ -238,79 +276,94 @@ class Helper(object):
         # if we have an empty rounting table,
         # try to get one from our direct connected
         # neighbor = backup
-        if len(routes) == 0 or routes is None:
+        if len(routes) == 0:
             Helper.requestrouting(initial=True)
 
-        # for all routes but myself
-        # send the full table
+        # all wis of the routing table but myself, and the
+        # conf peers which are not in the routing table
+        wisurls = set([route["wisurl"] for route in routes])
+        urls = []
         for route in routes:
-            # remove route von conf routes
-            # if exist
-            for p in list(peers):
-                if "url" not in p:
-                    continue
-                if route["wisurl"] == p["url"]:
-                    peers.remove(p)
-
-            if route["wisid"] != wisglobals.wisid:
-                smsgwglobals.wislogger.debug("Sending to "
-                                             + route["wisurl"])
-                # encode to json
-                jdata = json.dumps(routes)
-                data = GlobalHelper.encodeAES(jdata)
-
-                request = \
-                    urllib.request.Request(
-                        route["wisurl"] +
-                        "/api/receiverouting")
-
-                request.add_header("Content-Type",
-                                   "application/json;charset=utf-8")
-
-                try:
-                    f = urllib.request.urlopen(request, data, timeout=5)
-                    smsgwglobals.wislogger.debug(f.getcode())
-                except urllib.error.URLError as e:
-                    smsgwglobals.wislogger.debug(e)
-                    smsgwglobals.wislogger.debug("Get peers NOTOK")
-                except socket.timeout as e:
-                    smsgwglobals.wislogger.debug(e)
-                    smsgwglobals.wislogger.debug("HELPER: receiverouting socket connection timeout")
-
-        # check if there are remaining peers which
-        # are not recognized by routing table to send
-        # routing table to
-        if len(peers) != 0:
-            for p in peers:
-                if "url" not in p:
-                    continue
-                jdata = json.dumps(routes)
-                data = GlobalHelper.encodeAES(jdata)
-
-                request = \
-                    urllib.request.Request(
-                        p["url"] +
-                        "/api/receiverouting")
-
-                request.add_header("Content-Type",
-                                   "application/json;charset=utf-8")
-
-                try:
-                    f = urllib.request.urlopen(request, data, timeout=5)
-                    smsgwglobals.wislogger.debug(f.getcode())
-                    smsgwglobals.wislogger.debug("HELPER: " +
-                                                 "sending to " +
-                                                 p["url"])
-                except urllib.error.URLError as e:
-                    smsgwglobals.wislogger.debug(e)
-                    smsgwglobals.wislogger.debug("Get peers NOTOK")
-                    pass
-                except socket.timeout as e:
-                    smsgwglobals.wislogger.debug(e)
-                    smsgwglobals.wislogger.debug("HELPER: receiverouting socket connection timeout")
-                except socket.error as e:
-                    smsgwglobals.wislogger.debug(e)
-                    smsgwglobals.wislogger.debug("HELPER: receiverouting socket connection error")
+            if route["wisid"] != wisglobals.wisid and route["wisurl"] not in urls:
+                urls.append(route["wisurl"])
+        for p in peers:
+            if "url" in p and p["url"] not in wisurls and p["url"] not in urls:
+                urls.append(p["url"])
+
+        peerclient.fanout(Helper.sendrouting, urls, 6)
+
+    @staticmethod
+    def sendrouting(url):
+        """Send the routing entries changed since the last successful
+        send to url, the whole table after a failure, every
+        routingfullsync seconds and at once if the peer restarted or
+        has an empty table. Liveness goes separately only to peers
+        which said they understand it, others get plain lists.
+        """
+        now = time.monotonic()
+        with routingpeerslock:
+            peer = routingpeers.get(url)
+        if peer is None or now - peer["fullsync"] >= wisglobals.routingfullsync:
+            since = 0
+            fullsync = now
+        else:
+            since = peer["version"]
+            fullsync = peer["fullsync"]
+
+        liveness = peer is not None and peer["alive"]
+        changes, alive, version = wisglobals.rdb.read_routing_changes(since, liveness)
+        if since and not changes and not alive:
+            smsgwglobals.wislogger.debug("HELPER: no routing changes for " + url)
+            return
+
+        smsgwglobals.wislogger.debug("HELPER: sending " + str(len(changes)) +
+                                     " routing entries and " + str(len(alive)) +
+                                     " alive to " + url)
+        # encode to json, a full sync stays a plain list
+        if alive:
+            jdata = json.dumps({"routes": changes, "alive": alive})
+        else:
+            jdata = json.dumps(changes)
+        data = GlobalHelper.encodeAES(jdata)
+
+        try:
+            f = peerclient.post(url + "/api/receiverouting", data, timeout=5)
+            smsgwglobals.wislogger.debug(f.status_code)
+            reply = Helper.routingreply(f.text)
+            with routingpeerslock:
+                routingpeers[url] = {"version": version, "fullsync": fullsync,
+                                     "alive": reply.get("alive", False),
+                                     "bootid": reply.get("bootid")}
+            if since and (reply.get("fullsync") or
+                          reply.get("bootid") != peer["bootid"]):
+                # the peer restarted or lost its table, it needs all
+                # the entries it did not get changed
+                smsgwglobals.wislogger.debug("HELPER: full routing for " + url)
+                with routingpeerslock:
+                    routingpeers.pop(url, None)
+                Helper.sendrouting(url)
+            return
+        except requests.exceptions.Timeout as e:
+            smsgwglobals.wislogger.debug(e)
+            smsgwglobals.wislogger.debug("HELPER: receiverouting socket connection timeout")
+        except requests.exceptions.RequestException as e:
+            smsgwglobals.wislogger.debug(e)
+            smsgwglobals.wislogger.debug("Get peers NOTOK")
+
+        # the peer may have missed entries, send all of them next time
+        with routingpeerslock:
+            routingpeers.pop(url, None)
+
+    @staticmethod
+    def routingreply(text):
+        # older WIS answer receiverouting with an empty body
+        if not text:
+            return {}
+        try:
+            return json.loads(GlobalHelper.decodeAES(text))
+        except (ValueError, IndexError) as e:
+            smsgwglobals.wislogger.debug(e)
+            return {}
 
     @staticmethod
     def requestrouting(peers=None, initial=False):
@@ -318,34 +371,23 @@ class Helper(object):
         def getUrl(url):
             try:
                 data = GlobalHelper.encodeAES('{"get": "peers"}')
-                request = \
-                    urllib.request.Request(url +
-                                           "/api/requestrouting")
-                request.add_header("Content-Type",
-                                   "application/json;charset=utf-8")
-                f = urllib.request.urlopen(request, data, timeout=5)
-                if f.getcode() != 200:
-                    smsgwglobals.wislogger.debug("Get peers NOTOK," +
-                                                 " Error Code: ",
-                                                 f.getcode())
-                    return
+                f = peerclient.post(url + "/api/requestrouting", data, timeout=5)
 
                 smsgwglobals.wislogger.debug("Get peers OK")
-                rawbody = f.read().decode('utf-8')
-                plaintext = GlobalHelper.decodeAES(rawbody)
+                plaintext = GlobalHelper.decodeAES(f.text)
                 routelist = json.loads(plaintext)
                 smsgwglobals.wislogger.debug(routelist)
 
                 wisglobals.rdb.merge_routing(routelist)
 
-            except urllib.error.URLError as e:
+            except requests.exceptions.Timeout as e:
+                smsgwglobals.wislogger.debug(e)
+                smsgwglobals.wislogger.debug("HELPER: requestrouting socket connection timeout")
+            except requests.exceptions.RequestException as e:
                 smsgwglobals.wislogger.debug(e)
                 smsgwglobals.wislogger.debug("Get peers NOTOK")
             except error.DatabaseError as e:
                 smsgwglobals.wislogger.debug(e.message)
-            except socket.timeout as e:
-                smsgwglobals.wislogger.debug(e)
-                smsgwglobals.wislogger.debug("HELPER: requestrouting socket connection timeout")
 
         if initial is True:
             abspath = path.abspath(path.join(path.dirname(__file__),
@@ -357,11 +399,9 @@ class Helper(object):
             smsgwglobals.wislogger.debug(peersjson)
             peers = json.loads(peersjson)
 
-            for peer in peers:
-                if "url" not in peer:
-                    continue
-                smsgwglobals.wislogger.debug(peer["url"])
-                getUrl(peer["url"])
+            urls = [peer["url"] for peer in peers if "url" in peer]
+            smsgwglobals.wislogger.debug(urls)
+            peerclient.fanout(getUrl, urls, 6)
 
     @staticmethod
     def checkpassword(username, password):
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# Copyright 2015 Neuhold Markus and Kleinsasser Mario
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from queue import Queue, Full
+
+from common import smsgwglobals
+
+
+class IngestionExecutor(object):
+    """Fixed number of worker threads behind a bounded queue
+
+    submit() never blocks, it returns False if the queue is full so
+    the API can answer with 503 instead of piling up threads.
+    """
+
+    def __init__(self, workers, queuesize):
+        self.queue = Queue(maxsize=queuesize)
+        self.lock = threading.Lock()
+        self.workers = []
+        self.busy = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.failed = 0
+        for i in range(workers):
+            worker = threading.Thread(target=self.run,
+                                      name="Ingestion-" + str(i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, fn, *args):
+        try:
+            self.queue.put_nowait((fn, args))
+        except Full:
+            with self.lock:
+                self.rejected += 1
+            return False
+        with self.lock:
+            self.accepted += 1
+        return True
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                break
+            fn, args = job
+            with self.lock:
+                self.busy += 1
+            try:
+                fn(*args)
+            except Exception as e:
+                with self.lock:
+                    self.failed += 1
+                smsgwglobals.wislogger.debug("INGESTION: job failed " + str(e))
+            finally:
+                with self.lock:
+                    self.busy -= 1
+                self.queue.task_done()
+
+    def shutdown(self):
+        # queued jobs are processed before the workers stop
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def stats(self):
+        with self.lock:
+            return {'workers': len(self.workers),
+                    'busy': self.busy,
+                    'depth': self.queue.qsize(),
+                    'queuesize': self.queue.maxsize,
+                    'accepted': self.accepted,
+                    'rejected': self.rejected,
+                    'failed': self.failed}
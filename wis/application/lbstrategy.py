@@ -0,0 +1,252 @@
+#!/usr/bin/python
+# Copyright 2015 Neuhold Markus and Kleinsasser Mario
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+sys.path.insert(0, "..")
+import threading
+from application import wisglobals
+
+
+def weight(route):
+    return route["lbfactor"] or 1
+
+
+class LeastLoad(object):
+    """Route with the lowest sms_count / lbfactor, the last one on a tie
+    """
+
+    name = "leastload"
+
+    def select(self, routes, picks):
+        lbcount = None
+        selectedroute = None
+        for route in routes:
+            load = route["sms_count"] / weight(route)
+            if lbcount is None or load <= lbcount:
+                lbcount = load
+                selectedroute = route
+        return selectedroute
+
+
+class WeightedRoundRobin(object):
+    """Smooth weighted round robin with lbfactor as weight
+
+    Every pick adds the weight to the current value of each route, the
+    route with the highest value is taken and set back by the sum of
+    the weights.
+    """
+
+    name = "wrr"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = {}
+
+    def select(self, routes, picks):
+        with self.lock:
+            total = 0
+            selectedroute = None
+            for route in routes:
+                routingid = route["routingid"]
+                self.current[routingid] = self.current.get(routingid, 0) + weight(route)
+                total += weight(route)
+                if selectedroute is None or \
+                        self.current[routingid] > self.current[selectedroute["routingid"]]:
+                    selectedroute = route
+            self.current[selectedroute["routingid"]] -= total
+        return selectedroute
+
+    def forget(self, routingid):
+        with self.lock:
+            self.current.pop(routingid, None)
+
+
+class LeastOutstanding(object):
+    """Route with the fewest outstanding sends
+
+    Outstanding are the sms waiting in the watchdog queue of a route,
+    the sms sent to PIS still waiting for their status (see sent/done)
+    and the picks, sms given to a route in the same reservation which
+    are not queued yet. Ties go to the lowest sms_count / lbfactor.
+    """
+
+    name = "outstanding"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # routingid -> number of sms waiting for their status
+        self.pending = {}
+
+    def sent(self, routingid):
+        with self.lock:
+            self.pending[routingid] = self.pending.get(routingid, 0) + 1
+
+    def done(self, routingid):
+        with self.lock:
+            count = self.pending.get(routingid, 0) - 1
+            if count > 0:
+                self.pending[routingid] = count
+            else:
+                self.pending.pop(routingid, None)
+
+    def forget(self, routingid):
+        with self.lock:
+            self.pending.pop(routingid, None)
+
+    def select(self, routes, picks):
+        queues = wisglobals.watchdogRouteThreadQueue
+        with self.lock:
+            pending = dict(self.pending)
+        selectedroute = None
+        lowest = None
+        for route in routes:
+            routingid = route["routingid"]
+            queue = queues.get(routingid)
+            depth = queue.qsize() if queue is not None else 0
+            outstanding = depth + pending.get(routingid, 0) + picks.get(routingid, 0)
+            key = (outstanding / weight(route),
+                   route["sms_count"] / weight(route))
+            if lowest is None or key < lowest:
+                lowest = key
+                selectedroute = route
+        return selectedroute
+
+
+class Ewma(object):
+    """Route with the lowest expected cost from observed sends
+
+    Keeps an exponentially weighted moving average of the PIS send
+    latency and success rate per route (see observe). The cost of a
+    route is latency / success rate times its sms_count / lbfactor, so
+    a route twice as slow gets half the share. Routes without samples
+    are assumed to be average.
+    """
+
+    name = "ewma"
+    alpha = 0.2
+    minsuccess = 0.05
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # routingid -> [latency, success rate]
+        self.stats = {}
+
+    def observe(self, routingid, seconds, success):
+        with self.lock:
+            stat = self.stats.get(routingid)
+            if stat is None:
+                self.stats[routingid] = [seconds, 1.0 if success else 0.0]
+                return
+            stat[0] += self.alpha * (seconds - stat[0])
+            stat[1] += self.alpha * ((1.0 if success else 0.0) - stat[1])
+
+    def forget(self, routingid):
+        with self.lock:
+            self.stats.pop(routingid, None)
+
+    def select(self, routes, picks):
+        with self.lock:
+            known = [self.stats[route["routingid"]] for route in routes
+                     if route["routingid"] in self.stats]
+            if known:
+                average = [sum(s[0] for s in known) / len(known),
+                           sum(s[1] for s in known) / len(known)]
+            else:
+                average = [1.0, 1.0]
+            selectedroute = None
+            lowest = None
+            for route in routes:
+                latency, success = self.stats.get(route["routingid"], average)
+                cost = (latency / max(success, self.minsuccess) *
+                        (route["sms_count"] + 1) / weight(route))
+                if lowest is None or cost <= lowest:
+                    lowest = cost
+                    selectedroute = route
+        return selectedroute
+
+
+strategies = dict([(strategy.name, strategy) for strategy in
+                   (LeastLoad(), WeightedRoundRobin(), LeastOutstanding(), Ewma())])
+
+
+def getstrategy(name):
+    return strategies.get(name, strategies["leastload"])
+
+
+def selector(name=None):
+    """Select function for one reservation (see routingdb reserve_routes)
+    using the [wis] lbstrategy
+    """
+    strategy = getstrategy(name or wisglobals.lbstrategy)
+    picks = {}
+
+    def select(routes):
+        # if only one possibility just take it
+        if len(routes) == 1:
+            route = routes[0]
+        else:
+            route = strategy.select(routes, picks)
+        picks[route["routingid"]] = picks.get(route["routingid"], 0) + 1
+        return route
+    return select
+
+
+def sent(routingid):
+    """An sms was handed to PIS, its status is outstanding
+    """
+    strategies["outstanding"].sent(routingid)
+
+
+def done(routingid):
+    """The sms is no longer outstanding without a result to observe
+    """
+    strategies["outstanding"].done(routingid)
+
+
+def observe(routingid, seconds, success):
+    """Result of a send to PIS, seconds until the status was known
+    """
+    done(routingid)
+    strategies["ewma"].observe(routingid, seconds, success)
+
+
+def forget(routingid):
+    strategies["wrr"].forget(routingid)
+    strategies["outstanding"].forget(routingid)
+    strategies["ewma"].forget(routingid)
+
+
+if __name__ == "__main__":
+    # micro-benchmark, from wis/: python3 -m application.lbstrategy [routes]
+    from timeit import timeit
+    from application.smsqueue import SmsQueue
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    routes = [{"routingid": "r" + str(i), "modemid": "m" + str(i),
+               "sms_count": i * 7 % 50, "lbfactor": 1 + i % 3}
+              for i in range(count)]
+    for i, route in enumerate(routes):
+        queue = SmsQueue()
+        for j in range(i % 5):
+            queue.put(j)
+        wisglobals.watchdogRouteThreadQueue[route["routingid"]] = queue
+        strategies["ewma"].observe(route["routingid"], 0.5 + i % 4, i % 7 != 0)
+
+    number = 20000
+    for name in sorted(strategies):
+        select = selector(name)
+        seconds = timeit(lambda: select(routes), number=number)
+        print("%-12s %3d routes %8.2f us/select" %
+              (name, count, seconds / number * 1000000))
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# Copyright 2015 Neuhold Markus and Kleinsasser Mario
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+sys.path.insert(0, "..")
+import threading
+import requests
+import urllib3
+from concurrent.futures import ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
+from application import wisglobals
+
+# like urllib in wis.py peers are not verified
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+lock = threading.Lock()
+session = None
+executor = None
+
+
+def workers():
+    return wisglobals.peerworkers or 8
+
+
+def getsession():
+    """Shared session keeping connections to the peers alive
+    """
+    global session
+    with lock:
+        if session is None:
+            adapter = HTTPAdapter(pool_connections=workers(),
+                                  pool_maxsize=workers())
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.verify = False
+            session.headers["Content-Type"] = "application/json;charset=utf-8"
+        return session
+
+
+def getexecutor():
+    global executor
+    with lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=workers(),
+                                          thread_name_prefix="Peer")
+        return executor
+
+
+def get(url, timeout=5):
+    return getsession().get(url, timeout=timeout)
+
+
+def post(url, data, timeout=5):
+    response = getsession().post(url, data=data, timeout=timeout)
+    response.raise_for_status()
+    return response
+
+
+def fanout(function, items, deadline):
+    """Call function(item) for all items at once and wait at most
+    deadline seconds for them
+
+    Returns (item, result, exception) in the order of items, calls not
+    done in time get a requests Timeout and finish in the background.
+    Must not be called from function itself, the pool would run dry.
+    """
+    pool = getexecutor()
+    futures = [(item, pool.submit(function, item)) for item in items]
+    done, notdone = wait([future for item, future in futures], timeout=deadline)
+
+    results = []
+    for item, future in futures:
+        if future not in done:
+            results.append((item, None,
+                            requests.exceptions.Timeout("deadline exceeded")))
+        elif future.exception() is not None:
+            results.append((item, None, future.exception()))
+        else:
+            results.append((item, future.result(), None))
+    return results
+
+
+def shutdown():
+    global session, executor
+    with lock:
+        if executor is not None:
+            executor.shutdown(wait=False)
+            executor = None
+        if session is not None:
+            session.close()
+            session = None
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# Copyright 2015 Neuhold Markus and Kleinsasser Mario
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from random import uniform
+from time import monotonic
+from common import smsgwglobals
+from application import wisglobals
+
+# routingid -> TokenBucket
+buckets = {}
+bucketslock = threading.Lock()
+
+
+class TokenBucket(object):
+    """Token bucket pacing the sms of one route
+
+    rate ... sms per minute
+    burst ... number of sms which may be sent back to back
+    jitter ... max seconds of random delay added to each wait
+    """
+
+    def __init__(self, rate, burst, jitter):
+        self.lock = threading.Lock()
+        self.configure(rate, burst, jitter)
+        self.tokens = float(self.burst)
+        self.last = monotonic()
+
+    def configure(self, rate, burst, jitter):
+        with self.lock:
+            self.rate = max(float(rate), 0.001) / 60.0
+            self.burst = max(int(burst), 1)
+            self.jitter = max(float(jitter), 0.0)
+
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self, stop):
+        """Wait until a token is available and take it
+
+        Returns False without taking a token if the stop event is set
+        while waiting.
+        """
+        while not stop.is_set():
+            with self.lock:
+                self.refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    wait = 0
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            if wait == 0:
+                if self.jitter and stop.wait(uniform(0, self.jitter)):
+                    # stopped during the jitter, give the token back
+                    with self.lock:
+                        self.refill()
+                        self.tokens = min(self.burst, self.tokens + 1)
+                    return False
+                return True
+            stop.wait(wait)
+        return False
+
+
+def getbucket(route):
+    """Return the bucket of a route, rates come from the route (set by
+    the PID carrierscfg) or fall back to the [wis] defaults
+    """
+    routingid = route["routingid"]
+    rate = route.get("sms_per_minute") or wisglobals.smsperminute
+    burst = route.get("sms_burst") or wisglobals.smsburst
+    jitter = route.get("sms_jitter")
+    if jitter is None:
+        jitter = wisglobals.smsjitter
+
+    with bucketslock:
+        bucket = buckets.get(routingid)
+        if bucket is None:
+            smsgwglobals.wislogger.debug("RATELIMIT: [route: " + str(routingid) +
+                                         "] " + str(rate) + " sms/min burst " +
+                                         str(burst) + " jitter " + str(jitter))
+            bucket = TokenBucket(rate, burst, jitter)
+            buckets[routingid] = bucket
+        else:
+            bucket.configure(rate, burst, jitter)
+    return bucket
+
+
+def removebucket(routingid):
+    with bucketslock:
+        buckets.pop(routingid, None)
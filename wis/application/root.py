@@ -18,8 +18,10 @@ import collections
 import urllib.request
 import json
 import socket
+import requests
 from common.helper import GlobalHelper
 from application import wisglobals
+from application import peerclient
 from common import smsgwglobals
 from common import database
 from .html import Htmlpage
@@ -240,28 +242,26 @@ class Ajax():
             if len(entries) == 0:
                 return "No Wis Urls"
             else:
-                for entry in entries:
-                    try:
-                        if date is None:
-                            data = GlobalHelper.encodeAES('{"get": "sms"}')
-                        else:
-                            data = GlobalHelper.encodeAES('{"get": "sms", "date": "' + str(date) + '"}')
-
-                        request = urllib.request.Request(entry["wisurl"] +
-                                                         "/api/getsms")
-                        request.add_header("Content-Type",
-                                           "application/json;charset=utf-8")
-                        f = urllib.request.urlopen(request, data, timeout=30)
-                        resp = f.read().decode('utf-8')
-                        respdata = GlobalHelper.decodeAES(resp)
-                        smsen = smsen + json.loads(respdata)
-
-                    except urllib.error.URLError as e:
-                        smsgwglobals.wislogger.debug(e)
-                        smsgwglobals.wislogger.debug("AJAX: getsms connect error")
-                    except socket.timeout as e:
+                if date is None:
+                    data = GlobalHelper.encodeAES('{"get": "sms"}')
+                else:
+                    data = GlobalHelper.encodeAES('{"get": "sms", "date": "' + str(date) + '"}')
+
+                def getwissms(wisurl):
+                    f = peerclient.post(wisurl + "/api/getsms", data, timeout=30)
+                    return json.loads(GlobalHelper.decodeAES(f.text))
+
+                # ask all wis at once, keep the order of the entries
+                wisurls = [entry["wisurl"] for entry in entries]
+                for wisurl, wissmsen, e in peerclient.fanout(getwissms, wisurls, 31):
+                    if isinstance(e, requests.exceptions.Timeout):
                         smsgwglobals.wislogger.debug(e)
                         smsgwglobals.wislogger.debug("AJAX: getsms socket connection timeout")
+                    elif e is not None:
+                        smsgwglobals.wislogger.debug(e)
+                        smsgwglobals.wislogger.debug("AJAX: getsms connect error")
+                    else:
+                        smsen = smsen + wissmsen
 
         if smsen is None or len(smsen) == 0:
             return "No SMS in Tables found"
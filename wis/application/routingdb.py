@@ -15,159 +15,241 @@
 
 import sys
 sys.path.insert(0, "..")
-import sqlite3
 from datetime import datetime
 from datetime import timedelta
 from common import smsgwglobals
 from application import wisglobals
 from common import error
 from common import database
+from application.routingsnapshot import RoutingSnapshot
 import threading
 
+# serializes writers of the routing table, readers never lock
 rdblock = threading.Lock()
+# routing snapshot used to route sms, None if it has to be rebuilt
+snapshot = None
+snapshotlock = threading.Lock()
+# raised with every rebuild, sms routed on a snapshot carry its version
+snapshotversion = 0
+
+
+def integer(value):
+    # same conversion as the INTEGER column of the former routing table
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            pass
+    return value
+
+
+def real(value):
+    if isinstance(value, (int, str)) and not isinstance(value, bool):
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    return value
+
+
+def text(value):
+    if value is None or isinstance(value, str):
+        return value
+    return str(value)
+
+
+class Route(object):
+    """One routing entry, never changed after it is in the table
+
+    Changes build a new Route with replace(). version is the value of
+    the table version when the entry was last changed, sms_count does
+    not count as a change as every WIS counts on its own. A heartbeat
+    only refreshing changed sets alive instead of version, peers get
+    it as liveness (see read_routing_changes).
+    """
+
+    # in the order of read_routing
+    fields = ("wisid", "modemid", "regex", "sms_count", "sms_limit",
+              "account_balance", "imsi", "imei", "carrier", "lbfactor",
+              "wisurl", "pisurl", "modemname", "sim_blocked", "routingid",
+              "obsolete", "sms_per_minute", "sms_burst", "sms_jitter",
+              "changed")
+
+    __slots__ = fields + ("version", "alive")
+
+    webfields = ("modemid", "sms_count", "sms_limit", "account_balance",
+                 "imsi", "imei", "carrier", "modemname", "sim_blocked")
+
+    types = {"sms_count": integer, "sms_limit": integer, "lbfactor": integer,
+             "obsolete": integer, "sms_burst": integer,
+             "sms_per_minute": real, "sms_jitter": real,
+             "wisid": text, "modemid": text, "regex": text,
+             "account_balance": text, "imsi": text, "imei": text,
+             "carrier": text, "wisurl": text, "pisurl": text,
+             "modemname": text, "sim_blocked": text, "routingid": text,
+             "changed": text, "version": integer, "alive": integer}
+
+    def __init__(self, **kwargs):
+        for field in self.__slots__:
+            setattr(self, field, self.types[field](kwargs.get(field)))
+
+    def replace(self, **changes):
+        route = Route.__new__(Route)
+        for field in self.__slots__:
+            if field in changes:
+                setattr(route, field, self.types[field](changes[field]))
+            else:
+                setattr(route, field, getattr(self, field))
+        return route
+
+    def todict(self, fields=fields):
+        return dict([(field, getattr(self, field)) for field in fields])
+
+    def samerouting(self, other):
+        # equal apart from sms_count, changed and version
+        for field in self.fields:
+            if field not in ("sms_count", "changed") and \
+                    getattr(self, field) != getattr(other, field):
+                return False
+        return True
+
+
+def index(routes, field):
+    # field value -> tuple of routingids in table order
+    result = {}
+    for routingid, route in routes.items():
+        result.setdefault(getattr(route, field), []).append(routingid)
+    return dict([(key, tuple(ids)) for key, ids in result.items()])
 
 
 class Database(object):
+    """Routing table held as Route records with hash indexes
 
-    con = None
-    cur = None
+    table is (routes, bymodem, byimsi, bywisurl): routes maps routingid
+    to Route in insertion order, the others map modemid, imsi and
+    wisurl to tuples of routingids. Writers build a new table under
+    rdblock and swap it in, readers take the current one without a lock.
+    Every change and heartbeat raises version, see read_routing_changes.
+    """
 
-    # check_same_thread is only documented online
-    # it is needed if the memory database is used and also
-    # created in another thread
     def __init__(self):
-        self.con = sqlite3.connect(":memory:", check_same_thread=False)
-        self.con.row_factory = sqlite3.Row
-        self.cur = self.con.cursor()
-        self.create_table_routing()
-
-    # Create table and index for table routing
-    def create_table_routing(self):
-        smsgwglobals.wislogger.debug("ROUTERDB: Create table 'routing'")
-        query = ("CREATE TABLE IF NOT EXISTS routing (" +
-                 "wisid TEXT, " +
-                 "modemid TEXT, " +
-                 "regex TEXT, " +
-                 "sim_blocked TEXT, " +
-                 "sms_count INTEGER, " +
-                 "sms_limit INTEGER, " +
-                 "account_balance TEXT, " +
-                 "imsi TEXT, " +
-                 "imei TEXT, " +
-                 "carrier TEXT, " +
-                 "lbfactor INTEGER, " +
-                 "wisurl TEXT, " +
-                 "pisurl TEXT, " +
-                 "modemname TEXT, " +
-                 "routingid TEXT, " +
-                 "obsolete INTEGER, " +
-                 "changed TIMESTAMP, " +
-                 "PRIMARY KEY (routingid))")
-        self.cur.execute(query)
+        self.table = ({}, {}, {}, {})
+        self.version = 0
+
+    def nextversion(self):
+        # must be called with rdblock held
+        self.version += 1
+        return self.version
+
+    def settable(self, routes, reindex=True):
+        # must be called with rdblock held
+        if reindex:
+            self.table = (routes,
+                          index(routes, "modemid"),
+                          index(routes, "imsi"),
+                          index(routes, "wisurl"))
+        else:
+            self.table = (routes,) + self.table[1:]
+
+    def update(self, routingids, **changes):
+        # replace the given routes, must be called with rdblock held
+        routes = dict(self.table[0])
+        for routingid in routingids:
+            routes[routingid] = routes[routingid].replace(version=self.nextversion(),
+                                                          **changes)
+        self.settable(routes, reindex=False)
 
     # Read routing entries
     def read_routing(self, modemid=None, web=False):
         smsgwglobals.wislogger.debug("ROUTERDB: Read routing entries")
-        if web:
-            query = ("SELECT " +
-                     "modemid, " +
-                     "sms_count, " +
-                     "sms_limit, " +
-                     "account_balance, " +
-                     "imsi, " +
-                     "imei, " +
-                     "carrier, " +
-                     "modemname, " +
-                     "sim_blocked " +
-                     "FROM routing")
+        fields = Route.webfields if web else Route.fields
+        routes, bymodem = self.table[:2]
+        if modemid is None:
+            selected = routes.values()
         else:
-            query = ("SELECT " +
-                     "wisid, " +
-                     "modemid, " +
-                    "regex, " +
-                    "sms_count, " +
-                    "sms_limit, " +
-                    "account_balance, " +
-                    "imsi, " +
-                    "imei, " +
-                    "carrier, " +
-                    "lbfactor, " +
-                    "wisurl, " +
-                    "pisurl, " +
-                    "modemname, " +
-                    "sim_blocked, " +
-                    "routingid, " +
-                    "obsolete, " +
-                    "changed " +
-                    "FROM routing")
-        try:
-            if modemid is None:
-                rdblock.acquire()
-                result = self.cur.execute(query)
-            else:
-                query = query + " WHERE modemid = ?"
-                rdblock.acquire()
-                result = self.cur.execute(query, [modemid])
-
-        except Exception as e:
-            smsgwglobals.wislogger.critical("ROUTERDB: " + query +
-                                            " failed! [EXCEPTION]:%s", e)
-            raise error.DatabaseError("Unable to SELECT FROM routing! ", e)
-        else:
-            # convert rows to dict
-            routes = [dict(row) for row in result]
-            smsgwglobals.wislogger.debug("ROUTERDB: " + str(len(routes)) +
-                                         " routing entries selected.")
-            return routes
-        finally:
-            rdblock.release()
+            selected = [routes[routingid] for routingid in bymodem.get(modemid, ())]
+
+        # every caller gets own dicts
+        result = [route.todict(fields) for route in selected]
+        smsgwglobals.wislogger.debug("ROUTERDB: " + str(len(result)) +
+                                     " routing entries selected.")
+        return result
+
+    # True if there are no routing entries at all
+    def is_empty(self):
+        return len(self.table[0]) == 0
+
+    # Read routing entries changed after version since
+    def read_routing_changes(self, since=0, liveness=True):
+        """Returns the changed entries as dicts, the liveness of the
+        other entries as routingid -> changed for heartbeats after since
+        and the highest version among them, since if nothing changed.
+        Without liveness heartbeats come as changed entries.
+        """
+        routes = []
+        alive = {}
+        version = since
+        for route in self.table[0].values():
+            if route.version > since:
+                routes.append(route.todict())
+                version = max(version, route.version)
+            elif route.alive is not None and route.alive > since:
+                if liveness:
+                    alive[route.routingid] = route.changed
+                else:
+                    routes.append(route.todict())
+                version = max(version, route.alive)
+        smsgwglobals.wislogger.debug("ROUTERDB: " + str(len(routes)) +
+                                     " routing entries changed, " +
+                                     str(len(alive)) + " alive since " + str(since))
+        return routes, alive, version
 
     # Read routing entries
+    def read_snapshot(self):
+        """Return the RoutingSnapshot of the current routing table
+        """
+        global snapshot
+        global snapshotversion
+        current = snapshot
+        if current is not None:
+            return current
+        with snapshotlock:
+            if snapshot is None:
+                snapshotversion += 1
+                snapshot = RoutingSnapshot(self.read_routing(), snapshotversion)
+                smsgwglobals.wislogger.debug("ROUTERDB: Routing snapshot rebuilt")
+            return snapshot
+
+    # Version of the current snapshot, None if it was dropped
+    def read_snapshot_version(self):
+        current = snapshot
+        if current is None:
+            return None
+        return current.version
+
+    # Drop the snapshot after routing entries changed, must not be
+    # called with rdblock held
+    def invalidate_snapshot(self):
+        global snapshot
+        with snapshotlock:
+            snapshot = None
+
     def read_sms_count(self, routingid):
         smsgwglobals.wislogger.debug("ROUTERDB: Read routing entries")
-        query = ("SELECT " +
-                 "sms_count " +
-                 "FROM routing " +
-                 "WHERE routingid = ?")
-        try:
-            rdblock.acquire()
-            result = self.cur.execute(query, [routingid])
-
-        except Exception as e:
-            smsgwglobals.wislogger.critical("ROUTERDB: " + query +
-                                            " failed! [EXCEPTION]:%s", e)
-            raise error.DatabaseError("Unable to SELECT FROM routing! ", e)
-        else:
-            # convert rows to dict
-            routes = [dict(row) for row in result]
-            smsgwglobals.wislogger.debug("ROUTERDB: " + str(len(routes)) +
-                                         " routing entries selected.")
-            return routes
-        finally:
-            rdblock.release()
+        route = self.table[0].get(routingid)
+        if route is None:
+            return []
+        return [{"sms_count": route.sms_count}]
 
     # Read routing wisurls entries union
     def read_wisurls_union(self):
         smsgwglobals.wislogger.debug("ROUTERDB: Read wisurls union")
-        query = ("SELECT DISTINCT " +
-                 "wisurl " +
-                 "FROM routing")
-        try:
-            rdblock.acquire()
-            result = self.cur.execute(query)
-
-        except Exception as e:
-            smsgwglobals.wislogger.critical("ROUTERDB: " + query +
-                                            " failed! [EXCEPTION]:%s", e)
-            raise error.DatabaseError("Unable to SELECT FROM routing! ", e)
-        else:
-            # convert rows to dict
-            routes = [dict(row) for row in result]
-            smsgwglobals.wislogger.debug("ROUTERDB: " + str(len(routes)) +
-                                         " wis entries selected.")
-            return routes
-        finally:
-            rdblock.release()
+        routes = [{"wisurl": wisurl} for wisurl in self.table[3]]
+        smsgwglobals.wislogger.debug("ROUTERDB: " + str(len(routes)) +
+                                     " wis entries selected.")
+        return routes
 
     # Insert or replaces a list of routing entries
     def write_routing(self, route, changed=None):
@@ -185,292 +267,309 @@ class Database(object):
         wisurl ... text-url of wis
         obsolete ... route got flag for deletion
         modemname ... text-longtext of modem
+        sms_per_minute ... float-sending rate, None for WIS default
+        sms_burst ... int-sms sent back to back, None for WIS default
+        sms_jitter ... float-max random delay in s, None for WIS default
         changed ... datetime.utcnow-when changed
         """
-        query = ("INSERT OR REPLACE INTO routing " +
-                 "(wisid, modemid, regex, sms_count, sms_limit, account_balance, imsi, imei, carrier, lbfactor, wisurl, " +
-                 "pisurl, obsolete, modemname, sim_blocked, routingid, changed) " +
-                 "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ")
+        self.write_routings([(route, changed)])
 
+    def write_routings(self, entries):
+        """Insert or replace a list of (route, changed) in one step, see
+        write_routing. Entries that differ from the table only in
+        changed keep the routing snapshot.
+        """
         # read sms_count if exist
         db = database.Database()
-        sms_count = db.read_sms_count_by_imsi(route["imsi"])
-
-        if changed is None:
-            changed = datetime.utcnow()
-
-        try:
-            smsgwglobals.wislogger.debug("ROUTERDB: Write into routing" +
-                                         " :wisid: " + route["wisid"] +
-                                         " :modemid: " + route["modemid"] +
-                                         " :regex: " + route["regex"] +
-                                         " :sms_count: " + str(sms_count) +
-                                         " :sms_limit: " + str(route["sms_limit"]) +
-                                         " :account_balance: " + str(route["account_balance"]) +
-                                         " :imsi: " + route["imsi"] +
-                                         " :imei: " + route["imei"] +
-                                         " :carrier: " + route["carrier"] +
-                                         " :lbfactor: " + str(route["lbfactor"]) +
-                                         " :wisurl: " + route["wisurl"] +
-                                         " :pisurl: " + route["pisurl"] +
-                                         " :obsolete: " + str(route["obsolete"]) +
-                                         " :modemname: " + route["modemname"] +
-                                         " :sim_blocked: " + route["sim_blocked"] +
-                                         " :routingid: " + route["routingid"] +
-                                         " :changed: " + str(changed))
-            rdblock.acquire()
-            self.cur.execute(query, (route["wisid"],
-                                     route["modemid"],
-                                     route["regex"],
-                                     sms_count,
-                                     route["sms_limit"],
-                                     route["account_balance"],
-                                     route["imsi"],
-                                     route["imei"],
-                                     route["carrier"],
-                                     route["lbfactor"],
-                                     route["wisurl"],
-                                     route["pisurl"],
-                                     route["obsolete"],
-                                     route["modemname"],
-                                     route["sim_blocked"],
-                                     route["routingid"],
-                                     changed))
-            self.con.commit()
-            smsgwglobals.wislogger.debug("ROUTERDB: INSERT!")
-
-        except Exception as e:
-            smsgwglobals.wislogger.critical("ROUTERDB: " + query +
-                                            " failed! [EXCEPTION]:%s", e)
-            raise error.DatabaseError("Unable to INSERT routing entry! ", e)
-        finally:
-            rdblock.release()
+        records = []
+        for route, changed in entries:
+            sms_count = db.read_sms_count_by_imsi(route["imsi"])
+
+            if changed is None:
+                changed = datetime.utcnow()
+
+            try:
+                smsgwglobals.wislogger.debug("ROUTERDB: Write into routing" +
+                                             " :wisid: " + route["wisid"] +
+                                             " :modemid: " + route["modemid"] +
+                                             " :regex: " + route["regex"] +
+                                             " :sms_count: " + str(sms_count) +
+                                             " :sms_limit: " + str(route["sms_limit"]) +
+                                             " :account_balance: " + str(route["account_balance"]) +
+                                             " :imsi: " + route["imsi"] +
+                                             " :imei: " + route["imei"] +
+                                             " :carrier: " + route["carrier"] +
+                                             " :lbfactor: " + str(route["lbfactor"]) +
+                                             " :wisurl: " + route["wisurl"] +
+                                             " :pisurl: " + route["pisurl"] +
+                                             " :obsolete: " + str(route["obsolete"]) +
+                                             " :modemname: " + route["modemname"] +
+                                             " :sim_blocked: " + route["sim_blocked"] +
+                                             " :routingid: " + route["routingid"] +
+                                             " :changed: " + str(changed))
+                records.append(Route(wisid=route["wisid"],
+                                     modemid=route["modemid"],
+                                     regex=route["regex"],
+                                     sms_count=sms_count,
+                                     sms_limit=route["sms_limit"],
+                                     account_balance=route["account_balance"],
+                                     imsi=route["imsi"],
+                                     imei=route["imei"],
+                                     carrier=route["carrier"],
+                                     lbfactor=route["lbfactor"],
+                                     wisurl=route["wisurl"],
+                                     pisurl=route["pisurl"],
+                                     obsolete=route["obsolete"],
+                                     modemname=route["modemname"],
+                                     sim_blocked=route["sim_blocked"],
+                                     routingid=route["routingid"],
+                                     sms_per_minute=route.get("sms_per_minute"),
+                                     sms_burst=route.get("sms_burst"),
+                                     sms_jitter=route.get("sms_jitter"),
+                                     changed=changed))
+            except Exception as e:
+                smsgwglobals.wislogger.critical("ROUTERDB: Write into routing" +
+                                                " failed! [EXCEPTION]:%s", e)
+                raise error.DatabaseError("Unable to INSERT routing entry! ", e)
+
+        if not records:
+            return
+        changed = False
+        written = 0
+        with rdblock:
+            routes = dict(self.table[0])
+            for record in records:
+                current = routes.get(record.routingid)
+                if current is not None and current.samerouting(record) and \
+                        current.sms_count == record.sms_count:
+                    if current.changed == record.changed:
+                        # nothing new, keeps the version so it is not
+                        # sent around again
+                        continue
+                else:
+                    changed = True
+                # a replaced entry moves to the end like INSERT OR REPLACE
+                routes.pop(record.routingid, None)
+                record.version = self.nextversion()
+                routes[record.routingid] = record
+                written += 1
+            if written:
+                self.settable(routes)
+        smsgwglobals.wislogger.debug("ROUTERDB: " + str(written) + " INSERT!")
+        if changed:
+            self.invalidate_snapshot()
 
     # Delete routing entry by wisurl
     def delete_routing_wisurl(self, wisurl):
         smsgwglobals.wislogger.debug("ROUTERDB: Deleting" +
                                      " routing entries...")
 
-        try:
-            query = ("UPDATE routing SET " +
-                     "obsolete = 14 " +
-                     "WHERE wisurl = ? " +
-                     "AND obsolete < 14")
-
-            rdblock.acquire()
-            result = self.cur.execute(query, [wisurl])
-            count = result.rowcount
-            self.con.commit()
-            smsgwglobals.wislogger.debug("ROUTERDB: " + str(count) +
-                                         " routing DELETE WISURL!")
-        except Exception as e:
-            smsgwglobals.wislogger.critical("ROUTERDB: " + query +
-                                            " failed! [EXCEPTION]:%s", e)
-            raise error.DatabaseError("Unable to DELETE from routing! ", e)
-        finally:
-            rdblock.release()
+        with rdblock:
+            routes, bymodem, byimsi, bywisurl = self.table
+            routingids = [routingid for routingid in bywisurl.get(wisurl, ())
+                          if routes[routingid].obsolete < 14]
+            count = len(routingids)
+            if count:
+                self.update(routingids, obsolete=14)
+        smsgwglobals.wislogger.debug("ROUTERDB: " + str(count) +
+                                     " routing DELETE WISURL!")
+        if count:
+            self.invalidate_snapshot()
 
     # Delete routing entry by routingid or obsolete
     def delete_routing(self, routingid=None):
         smsgwglobals.wislogger.debug("ROUTERDB: Deleting" +
                                      " routing entries...")
 
-        try:
-            if (routingid is None):
-                query = ("DELETE FROM routing " +
-                         "WHERE obsolete = ?")
-                rdblock.acquire()
-                result = self.cur.execute(query, [16])
+        with rdblock:
+            routes = self.table[0]
+            if routingid is None:
+                keep = dict([(rid, route) for rid, route in routes.items()
+                             if route.obsolete != 16])
             else:
-                query = ("DELETE FROM routing " +
-                         "WHERE routingid = ?")
-                rdblock.acquire()
-                result = self.cur.execute(query, routingid)
-
-            count = result.rowcount
-            self.con.commit()
-            smsgwglobals.wislogger.debug("ROUTERDB: " + str(count) +
-                                         " routing DELETE MAIN!")
-        except Exception as e:
-            smsgwglobals.wislogger.critical("ROUTERDB: " + query +
-                                            " failed! [EXCEPTION]:%s", e)
-            raise error.DatabaseError("Unable to DELETE from routing! ", e)
-        finally:
-            rdblock.release()
+                keep = dict([(rid, route) for rid, route in routes.items()
+                             if rid != routingid])
+            count = len(routes) - len(keep)
+            if count:
+                self.settable(keep)
+        smsgwglobals.wislogger.debug("ROUTERDB: " + str(count) +
+                                     " routing DELETE MAIN!")
+        if count:
+            self.invalidate_snapshot()
 
     # Update all routing entries set sms_count = 0
     def reset_sms_count(self, routingid):
         smsgwglobals.wislogger.debug("ROUTERDB: Reset sms_count")
 
-        try:
-            query = ("UPDATE routing SET " +
-                     "sms_count = ? " +
-                     "WHERE routingid = ? "
-                     )
-
-            rdblock.acquire()
-            result = self.cur.execute(query, [0, routingid])
-            count = result.rowcount
-            self.con.commit()
-            smsgwglobals.wislogger.debug("ROUTERDB: " + str(count) +
-                                         " sms_count CHANGED!")
-        except Exception as e:
-            smsgwglobals.wislogger.critical("ROUTERDB: " + query +
-                                            " failed! [EXCEPTION]:%s", e)
-            raise error.DatabaseError("Unable to reset sms_count! ", e)
-        finally:
-            rdblock.release()
+        with rdblock:
+            count = 0
+            if routingid in self.table[0]:
+                self.update([routingid], sms_count=0)
+                count = 1
+        smsgwglobals.wislogger.debug("ROUTERDB: " + str(count) +
+                                     " sms_count CHANGED!")
+        self.invalidate_snapshot()
 
     # Directoy change obsolete entry by routingid
     def change_obsolete(self, routingid, obsolete):
         smsgwglobals.wislogger.debug("ROUTERDB: Changing" +
                                      " routing entries...")
 
-        try:
-            query = ("UPDATE routing SET " +
-                     "obsolete = ? " +
-                     "WHERE routingid = ?"
-                     )
-
-            rdblock.acquire()
-            result = self.cur.execute(query, (obsolete, routingid))
-            count = result.rowcount
-            self.con.commit()
-            smsgwglobals.wislogger.debug("ROUTERDB: " + str(count) +
-                                         " routing OBSOLETE CHANGEG!")
-        except Exception as e:
-            smsgwglobals.wislogger.critical("ROUTERDB: " + query +
-                                            " failed! [EXCEPTION]:%s", e)
-            raise error.DatabaseError("Unable to change obsolete! ", e)
-        finally:
-            rdblock.release()
+        with rdblock:
+            count = 0
+            if routingid in self.table[0]:
+                self.update([routingid], obsolete=obsolete)
+                count = 1
+        smsgwglobals.wislogger.debug("ROUTERDB: " + str(count) +
+                                     " routing OBSOLETE CHANGEG!")
+        self.invalidate_snapshot()
 
     # Raise obsolte on timeout in routing
     def raise_obsolete(self):
         smsgwglobals.wislogger.debug("ROUTERDB: Raising Obsolete" +
                                      " routing entries...")
 
-        try:
-            now = datetime.utcnow()
-            older = now - timedelta(0, 30)
-
-            smsgwglobals.wislogger.debug("ROUTER " + str(now))
-            smsgwglobals.wislogger.debug("ROUTER " + str(older))
-
-            query = ("UPDATE routing SET " +
-                     "obsolete = obsolete + 2 " +
-                     "WHERE changed < ?"
-                     )
-
-            rdblock.acquire()
-            result = self.cur.execute(query, [older])
-            counta = result.rowcount
-
-            query = ("UPDATE routing SET " +
-                     "obsolete = 14 " +
-                     "WHERE obsolete = 1"
-                     )
-
-            result = self.cur.execute(query)
-            countb = result.rowcount
-
-            self.con.commit()
-            smsgwglobals.wislogger.debug("ROUTERDB: " + str(counta) +
-                                         str(countb) +
-                                         " routing OBSOLETE RAISED!")
-        except Exception as e:
-            smsgwglobals.wislogger.critical("ROUTERDB: " + query +
-                                            " failed! [EXCEPTION]:%s", e)
-            raise error.DatabaseError("Unable to change obsolete! ", e)
-        finally:
-            rdblock.release()
+        now = datetime.utcnow()
+        older = str(now - timedelta(0, 30))
+
+        smsgwglobals.wislogger.debug("ROUTER " + str(now))
+        smsgwglobals.wislogger.debug("ROUTER " + older)
+
+        with rdblock:
+            routes = dict(self.table[0])
+            counta = countb = 0
+            for routingid, route in routes.items():
+                if route.changed is not None and route.changed < older:
+                    route = route.replace(obsolete=route.obsolete + 2,
+                                          version=self.nextversion())
+                    counta += 1
+                if route.obsolete == 1:
+                    route = route.replace(obsolete=14,
+                                          version=self.nextversion())
+                    countb += 1
+                routes[routingid] = route
+            if counta or countb:
+                self.settable(routes, reindex=False)
+
+        smsgwglobals.wislogger.debug("ROUTERDB: " + str(counta) +
+                                     str(countb) +
+                                     " routing OBSOLETE RAISED!")
+        if counta or countb:
+            self.invalidate_snapshot()
+
+    # Add the counts (modemid -> number) to sms_count of the table
+    def count_routes(self, counts):
+        with rdblock:
+            routes = dict(self.table[0])
+            updated = 0
+            for modemid, count in counts.items():
+                for routingid in self.table[1].get(modemid, ()):
+                    route = routes[routingid]
+                    routes[routingid] = route.replace(sms_count=route.sms_count + count)
+                    updated += 1
+            self.settable(routes, reindex=False)
+        return updated
+
+    # Add the counts to the table and the snapshot, must be called
+    # with snapshotlock held
+    def add_sms_counts(self, counts):
+        updated = self.count_routes(counts)
+        if snapshot is not None:
+            for modemid, count in counts.items():
+                snapshot.raise_sms_count(modemid, count)
+        smsgwglobals.wislogger.debug("ROUTERDB: " + str(updated) +
+                                     " sms_count updated!")
+        return updated
 
     # Raise sms_count on the route
-    def raise_sms_count(self, modemid):
+    def raise_sms_count(self, modemid, count=1):
         smsgwglobals.wislogger.debug("ROUTERDB: Raising sms_count")
+        with snapshotlock:
+            return self.add_sms_counts({modemid: count})
 
-        try:
-            query = ("UPDATE routing SET " +
-                     "sms_count = sms_count + 1 " +
-                     "WHERE modemid = ? "
-                     )
-
-            rdblock.acquire()
-            result = self.cur.execute(query, [modemid])
-            count = result.rowcount
-            self.con.commit()
-            smsgwglobals.wislogger.debug("ROUTERDB: " + str(count) +
-                                         " sms_count updated!")
-            return count
-        except Exception as e:
-            smsgwglobals.wislogger.critical("ROUTERDB: " + query +
-                                            " failed! [EXCEPTION]:%s", e)
-            raise error.DatabaseError("Unable to change sms_count! ", e)
-        finally:
-            rdblock.release()
-
-    def decrease_sms_count(self, modemid):
+    def decrease_sms_count(self, modemid, count=1):
         smsgwglobals.wislogger.debug("ROUTERDB: Decreasing sms_count")
-
-        try:
-            query = ("UPDATE routing SET " +
-                     "sms_count = sms_count - 1 " +
-                     "WHERE modemid = ? "
-                     )
-
-            rdblock.acquire()
-            result = self.cur.execute(query, [modemid])
-            count = result.rowcount
-            self.con.commit()
-            smsgwglobals.wislogger.debug("ROUTERDB: " + str(count) +
-                                         " sms_count updated!")
-            return count
-        except Exception as e:
-            smsgwglobals.wislogger.critical("ROUTERDB: " + query +
-                                            " failed! [EXCEPTION]:%s", e)
-            raise error.DatabaseError("Unable to change sms_count! ", e)
-        finally:
-            rdblock.release()
+        with snapshotlock:
+            return self.add_sms_counts({modemid: -count})
+
+    def reserve_routes(self, targetnrs, select):
+        """Select a route for each target number and raise its sms_count
+        in one step, so concurrent callers never see the same counts.
+        select picks one of the eligible routes (see lbstrategy.selector).
+        Returns the list of selected route dicts, None where no route is
+        eligible, and the snapshot they were selected on.
+        """
+        while True:
+            current = self.read_snapshot()
+            with snapshotlock:
+                # dropped or rebuilt in the meantime
+                if snapshot is not current:
+                    continue
+                selected = []
+                counts = {}
+                for targetnr in targetnrs:
+                    possibleroutes = current.eligible(targetnr)
+                    if not possibleroutes:
+                        selected.append(None)
+                        continue
+                    route = select(possibleroutes)
+                    # count at once, the next number sees the new load
+                    current.raise_sms_count(route["modemid"])
+                    counts[route["modemid"]] = counts.get(route["modemid"], 0) + 1
+                    selected.append(route)
+                self.count_routes(counts)
+                return selected, current
+
+    def reserve_route(self, targetnr, select):
+        selected, current = self.reserve_routes([targetnr], select)
+        return selected[0], current
+
+    def release_routes(self, counts):
+        """Give back reservations (modemid -> number) of sms that were
+        not stored
+        """
+        smsgwglobals.wislogger.debug("ROUTERDB: Releasing sms_count")
+        with snapshotlock:
+            return self.add_sms_counts(dict([(modemid, -count) for modemid, count in counts.items()]))
 
     # Raise obsolte on timeout in routing
     def raise_heartbeat(self, routingid):
         smsgwglobals.wislogger.debug("ROUTERDB: Raising Heartbeat" +
                                      " routing entries...")
-
-        try:
-            now = datetime.utcnow()
-
-            smsgwglobals.wislogger.debug("ROUTERDB: NEW HEARTBEAT " + str(now))
-
-            query = ("UPDATE routing SET " +
-                     "changed = ? ," +
-                     "obsolete = 0 " +
-                     "WHERE routingid = ? " +
-                     "AND obsolete < 14"
-                     )
-
-            routes = self.read_routing()
-            current_route = [ route for route in routes if route['routingid'] == routingid ]
-            if current_route:
-                db = database.Database()
-                sms_count = db.read_sms_count_by_imsi(current_route[0]["imsi"])
-                # Looks like we enter new day - reset sms counter
-                if sms_count == 0:
-                    self.reset_sms_count(routingid)
-
-            rdblock.acquire()
-            result = self.cur.execute(query, [now, routingid])
-            count = result.rowcount
-            self.con.commit()
-            smsgwglobals.wislogger.debug("ROUTERDB: " + str(count) +
-                                         " routing HEARTBEAT updated!")
-            return count
-        except Exception as e:
-            smsgwglobals.wislogger.critical("ROUTERDB: " + query +
-                                            " failed! [EXCEPTION]:%s", e)
-            raise error.DatabaseError("Unable to change obsolete! ", e)
-        finally:
-            rdblock.release()
+        revived = False
+
+        now = datetime.utcnow()
+
+        smsgwglobals.wislogger.debug("ROUTERDB: NEW HEARTBEAT " + str(now))
+
+        current_route = self.table[0].get(routingid)
+        if current_route is not None:
+            db = database.Database()
+            sms_count = db.read_sms_count_by_imsi(current_route.imsi)
+            # Looks like we enter new day - reset sms counter
+            if sms_count == 0 and current_route.sms_count != 0:
+                self.reset_sms_count(routingid)
+            # only an obsolete route coming back changes the snapshot
+            revived = current_route.obsolete != 0
+
+        with rdblock:
+            count = 0
+            route = self.table[0].get(routingid)
+            if route is not None and route.obsolete < 14:
+                if route.obsolete != 0:
+                    self.update([routingid], changed=now, obsolete=0)
+                else:
+                    # liveness only, not sent as a changed entry
+                    routes = dict(self.table[0])
+                    routes[routingid] = route.replace(changed=now,
+                                                      alive=self.nextversion())
+                    self.settable(routes, reindex=False)
+                count = 1
+        smsgwglobals.wislogger.debug("ROUTERDB: " + str(count) +
+                                     " routing HEARTBEAT updated!")
+        if revived:
+            self.invalidate_snapshot()
+        return count
 
     # merge received routing entries
     def merge_routing(self, routes):
@@ -482,41 +581,51 @@ class Database(object):
                 smsgwglobals.wislogger.debug("MERGE: OWN WISID DELETE")
                 routes.remove(route)
 
-        # read local routes
-        localroutes = self.read_routing()
+        # local routes by routingid
+        localroutes = self.table[0]
 
-        # for all received routes
+        entries = []
         for route in routes:
-            # check if received route is in local routes
-            # found flag
-            found = False
-            for r in localroutes:
-                # if it is
-                if route["routingid"] == r["routingid"]:
-                    smsgwglobals.wislogger.debug("MERGE: Found")
-                    found = True
-                    # and if it es 0 vs < 3
-                    if route["obsolete"] == 0 and r["obsolete"] < 3:
-                        # overwrite
-                        smsgwglobals.wislogger.debug("ROUTER MERDED")
-                        smsgwglobals.wislogger.debug("ROUTER " +
-                                                     route["changed"])
-                        self.write_routing(route, route["changed"])
-                        # if route is obsolete, overwrite
-                    # elif route["obsolete"] >= 14:
-                        # overwrite
-                    #    self.write_routing(route, route["changed"])
-                    else:
-                        pass
-                    # nothing to change
-                else:
-                    pass
-            # nothing to change
-            # leave found flag False
+            r = localroutes.get(route["routingid"])
+            if r is not None:
+                smsgwglobals.wislogger.debug("MERGE: Found")
+                # and if it es 0 vs < 3 overwrite
+                if route["obsolete"] == 0 and r.obsolete < 3:
+                    smsgwglobals.wislogger.debug("ROUTER MERDED")
+                    smsgwglobals.wislogger.debug("ROUTER " +
+                                                 route["changed"])
+                    entries.append((route, route["changed"]))
             # check if route was not found
             # just add
-            if found is False:
-                # add route to local
-                if route["obsolete"] < 14:
-                    smsgwglobals.wislogger.debug("MERGE: Writing route")
-                    self.write_routing(route, route["changed"])
\ No newline at end of file
+            elif route["obsolete"] < 14:
+                smsgwglobals.wislogger.debug("MERGE: Writing route")
+                entries.append((route, route["changed"]))
+
+        # write all of them at once
+        self.write_routings(entries)
+
+    # merge received liveness, routingid -> changed
+    def merge_alive(self, alive):
+        smsgwglobals.wislogger.debug("MERGE: " + str(len(alive)) + " alive")
+        revived = False
+        with rdblock:
+            routes = dict(self.table[0])
+            count = 0
+            for routingid, changed in alive.items():
+                route = routes.get(routingid)
+                # same rule as merge_routing for a route not obsolete
+                if route is None or route.wisid == wisglobals.wisid or \
+                        route.obsolete >= 3:
+                    continue
+                if route.obsolete != 0:
+                    revived = True
+                    routes[routingid] = route.replace(changed=changed, obsolete=0,
+                                                      version=self.nextversion())
+                else:
+                    routes[routingid] = route.replace(changed=changed,
+                                                      alive=self.nextversion())
+                count += 1
+            if count:
+                self.settable(routes, reindex=False)
+        if revived:
+            self.invalidate_snapshot()
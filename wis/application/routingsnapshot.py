@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# Copyright 2015 Neuhold Markus and Kleinsasser Mario
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import threading
+
+# ^ followed by plain digits, e.g. "^38067" or "^\+38067"
+literalprefix = re.compile(r"^\^(\\\+)?([0-9]+)$")
+
+
+class RoutingSnapshot(object):
+    """Routing table prepared for matching target numbers
+
+    Routes sharing a regex are matched once with the precompiled
+    pattern. Pure ^literal patterns are looked up by prefix instead of
+    running a regex. Only sms_count changes on a snapshot, everything
+    else needs a new one (see routingdb.Database.read_snapshot).
+    """
+
+    def __init__(self, routes, version=0):
+        self.lock = threading.Lock()
+        self.routes = routes
+        self.version = version
+        self.order = {}
+        self.bymodem = {}
+        # prefix -> routes, and all used prefix lengths
+        self.prefixes = {}
+        self.prefixlengths = set()
+        # list of (compiled regex, routes)
+        self.patterns = []
+        self.fallback = []
+
+        groups = {}
+        for index, route in enumerate(routes):
+            self.order[route["routingid"]] = index
+            self.bymodem.setdefault(route["modemid"], []).append(route)
+            groups.setdefault(route["regex"], []).append(route)
+
+        for regex, group in groups.items():
+            match = literalprefix.match(regex)
+            if match is not None:
+                prefix = ("+" if match.group(1) else "") + match.group(2)
+                self.prefixes.setdefault(prefix, []).extend(group)
+                self.prefixlengths.add(len(prefix))
+            else:
+                try:
+                    compiled = re.compile(regex)
+                except (re.error, TypeError):
+                    continue
+                self.patterns.append((compiled, group))
+                if compiled.search("fallback") is not None:
+                    self.fallback.extend(group)
+
+        self.fallback.sort(key=self.sortkey)
+
+    def sortkey(self, route):
+        return self.order[route["routingid"]]
+
+    def matching(self, targetnr):
+        matched = []
+        for length in self.prefixlengths:
+            matched.extend(self.prefixes.get(targetnr[:length], ()))
+        for compiled, group in self.patterns:
+            if compiled.search(targetnr) is not None:
+                matched.extend(group)
+        # keep the order of the routing table
+        matched.sort(key=self.sortkey)
+        return matched
+
+    def eligible(self, targetnr):
+        """Routes able to send to targetnr, fallback routes if no route
+        matches the number
+        """
+        matched = self.matching(targetnr)
+        if not matched:
+            matched = self.fallback
+        return [route for route in matched
+                if route["obsolete"] < 1 and
+                route["sms_count"] < route["sms_limit"] and
+                route["sim_blocked"] != "Yes"]
+
+    def raise_sms_count(self, modemid, count=1):
+        with self.lock:
+            for route in self.bymodem.get(modemid, ()):
+                route["sms_count"] += count
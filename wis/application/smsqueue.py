@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# Copyright 2015 Neuhold Markus and Kleinsasser Mario
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+import itertools
+from queue import Queue
+
+
+class SmsQueue(Queue):
+    """Queue handing out the highest sms priority first
+
+    Items of the same priority keep their FIFO order, a running
+    sequence number breaks the tie on the heap. put() takes the
+    priority as keyword, everything else works like queue.Queue.
+    Priorities go from lowest to highest, others are clamped.
+    """
+
+    lowest = 0
+    highest = 9
+
+    @classmethod
+    def clamp(cls, priority):
+        return min(max(int(priority), cls.lowest), cls.highest)
+
+    def _init(self, maxsize):
+        self.heap = []
+        self.sequence = itertools.count()
+        self.prioritydepths = {}
+
+    def _qsize(self):
+        return len(self.heap)
+
+    def _put(self, entry):
+        priority, item = entry
+        heapq.heappush(self.heap, (-priority, next(self.sequence), item))
+        self.prioritydepths[priority] = self.prioritydepths.get(priority, 0) + 1
+
+    def _get(self):
+        negpriority, sequence, item = heapq.heappop(self.heap)
+        priority = -negpriority
+        self.prioritydepths[priority] -= 1
+        if self.prioritydepths[priority] == 0:
+            del self.prioritydepths[priority]
+        return item
+
+    def put(self, item, block=True, timeout=None, priority=1):
+        try:
+            priority = self.clamp(priority)
+        except (TypeError, ValueError):
+            priority = 1
+        super(SmsQueue, self).put((priority, item), block, timeout)
+
+    def put_nowait(self, item, priority=1):
+        return self.put(item, False, priority=priority)
+
+    def depths(self):
+        """Number of queued items per priority
+        """
+        with self.mutex:
+            return dict(self.prioritydepths)
@@ -93,12 +93,17 @@ class Smstransfer(object):
 
         self.smstransfer["sms"] = self.smsdict
 
+        # set by Helper.processsms_bulk, the routes of the selected modem
+        # and the version of the routing snapshot they were taken from
+        self.route = None
+        self.routingversion = None
+
     def appendroutes(self, routes):
         self.smstransfer["routes"] = routes
 
     def getjson(self):
         self.smstransfer["sms"] = self.smsdict
-        return json.dumps(self.smstransfer)
+        return json.dumps(self.smstransfer, default=str)
 
     def writetodb(self):
         try:
@@ -114,7 +119,8 @@ class Smstransfer(object):
                           self.smsdict["smsintime"],
                           self.smsdict["status"],
                           self.smsdict["statustime"],
-                          self.smsdict["smsid"])
+                          self.smsdict["smsid"],
+                          defer=True)
         except error.DatabaseError as e:
             smsgwglobals.wislogger.debug(e.message)
 
@@ -125,6 +131,6 @@ class Smstransfer(object):
             smsen.append(self.smsdict)
             smsgwglobals.wislogger.debug("WATCHDOG: " +
                                          "UPDATING " + str(self.smsdict["smsid"]) + " " + str(self.smsdict["status"]))
-            db.update_sms(smsen)
+            db.update_sms(smsen, defer=True)
         except error.DatabaseError as e:
             smsgwglobals.wislogger.debug(e.message)
@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# Copyright 2015 Neuhold Markus and Kleinsasser Mario
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import json
+
+
+def bodylines(body):
+    """Read an uploaded body line by line as str
+    """
+    while True:
+        line = body.readline()
+        if not line:
+            break
+        yield line.decode('utf-8')
+
+
+def ndjsonrows(lines):
+    """One recipient per line, either a number or an object with mobile
+    and optional content/appid overrides
+    """
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield {"error": ":line " + str(number) + " is not valid JSON"}
+            continue
+        if isinstance(row, dict):
+            yield dict([(k.lower(), v) for k, v in row.items()])
+        else:
+            yield {"mobile": str(row)}
+
+
+def csvrows(lines):
+    """CSV with a header row, columns mobile and optional content/appid
+    """
+    for row in csv.DictReader(lines):
+        yield dict([(k.strip().lower(), v.strip()) for k, v in row.items()
+                    if k is not None and v is not None])
+
+
+def readrows(body, contenttype):
+    lines = bodylines(body)
+    if contenttype is not None and "csv" in contenttype:
+        return csvrows(lines)
+    return ndjsonrows(lines)
+
+
+def chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
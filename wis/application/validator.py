@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# Copyright 2015 Neuhold Markus and Kleinsasser Mario
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+from common import smsgwglobals
+
+digits_regex = re.compile(r'^\d{12}$')
+
+
+class MobileValidator(object):
+    """Validates mobile numbers against allowedmobileprefixes
+
+    A number has to be 12 digits and match one prefix followed by 7
+    digits. Prefixes of 5 digits are looked up in a set on the first 5
+    digits, all others are compiled once into one alternation. Prefixes
+    which are no valid regex are left out with a warning.
+    """
+
+    def __init__(self, prefixes):
+        self.prefixes = prefixes
+        self.prefixset = set(p for p in prefixes if p.isdigit() and len(p) == 5)
+        patterns = []
+        for p in prefixes:
+            if p.isdigit():
+                if len(p) != 5:
+                    patterns.append(re.escape(p))
+                continue
+            try:
+                re.compile(p)
+            except re.error as e:
+                smsgwglobals.wislogger.warning("VALIDATOR: allowedmobileprefixes '" +
+                                               p + "' ignored: " + str(e))
+                continue
+            patterns.append('(?:' + p + ')')
+        if patterns:
+            self.prefixregex = re.compile('^(?:' + '|'.join(patterns) + r')\d{7}$')
+        else:
+            self.prefixregex = None
+
+    def isallowed(self, targetnr):
+        if targetnr[:5] in self.prefixset:
+            return True
+        return self.prefixregex is not None and self.prefixregex.search(targetnr) is not None
+
+    def validate(self, numbers):
+        """Returns the list of valid numbers and the list of messages
+        for the invalid ones, both in the order of numbers
+        """
+        numbers = [n if isinstance(n, str) else str(n) for n in numbers]
+        digits = [digits_regex.search(n) is not None for n in numbers]
+        allowed = [d and self.isallowed(n) for d, n in zip(digits, numbers)]
+
+        valid = []
+        invalid_messages = []
+        for targetnr, d, a in zip(numbers, digits, allowed):
+            if not d:
+                invalid_messages.append(":mobile number '" + targetnr + "' not valid. Should be 12 digits!")
+            elif not a:
+                invalid_messages.append(":mobile number '" + targetnr + "' not valid. Allowed prefixes: " + str(self.prefixes))
+            else:
+                valid.append(targetnr)
+        return valid, invalid_messages
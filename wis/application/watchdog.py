@@ -19,19 +19,25 @@ from common import database
 from common import error
 from common.helper import GlobalHelper
 from datetime import datetime, timedelta
-from time import sleep
 from apscheduler.schedulers.background import BackgroundScheduler
 from application import wisglobals
 from application.smstransfer import Smstransfer
 from application.helper import Helper
 from application import apperror
-from queue import Queue, Empty
+from application import ratelimit
+from application import lbstrategy
+from application.smsqueue import SmsQueue
+from queue import Empty
 import urllib.request
-from random import randrange
 import json
 import socket
 import pytz
 
+# smsid -> sms accepted by PIS, waiting for its status
+pendingsms = {}
+pendinglock = threading.Lock()
+
+
 class Watchdog_Scheduler():
     def __init__(self):
         self.db = database.Database()
@@ -50,6 +56,21 @@ class Watchdog_Scheduler():
         smsgwglobals.wislogger.debug("SCHEDULER: TRIGGER_WATCHDOGS job starting. Interval: 15 seconds")
         self.scheduler.add_job(self.trigger_watchdogs, 'interval', seconds = 15)
 
+        smsgwglobals.wislogger.debug("SCHEDULER: EXPIRE_PENDING_SMS job starting. Interval: 30 seconds")
+        self.scheduler.add_job(self.expire_pending_sms, 'interval', seconds = 30)
+
+    def expire_pending_sms(self):
+        # sms accepted by PIS without a status in time are handled like
+        # a PIS timeout (1000), PIS itself reports 1000 after maxwaitpid
+        until = datetime.utcnow() - timedelta(seconds=wisglobals.smsstatustimeout)
+        with pendinglock:
+            expired = [smsid for smsid in pendingsms if pendingsms[smsid]["time"] < until]
+        for smsid in expired:
+            pending = Watchdog_Route.poppending(smsid, 1000)
+            if pending is not None:
+                smsgwglobals.wislogger.debug("EXPIRE_PENDING_SMS job: no status for " + smsid)
+                Watchdog_Route.handlestatus(pending["sms"], 1000, pending["routingid"])
+
     def trigger_watchdogs(self):
         for route_watchdog in wisglobals.watchdogRouteThreadNotify:
             smsgwglobals.wislogger.debug("SCHEDULER: TRIGGER_WATCHDOG [" + str(route_watchdog) + "] force triggered!")
@@ -112,7 +133,7 @@ class Watchdog_Scheduler():
                         pass
                     else:
                         # Add sms to global queue
-                        wisglobals.watchdogThread.queue.put(smstrans.smsdict["smsid"])
+                        wisglobals.watchdogThread.queue.put(smstrans.smsdict["smsid"], priority=smstrans.smsdict["priority"])
                         wisglobals.watchdogThreadNotify.set()
             else:
                 smsgwglobals.wislogger.debug("REPROCESS_SMS job: skipping. NO SMS to process")
@@ -140,7 +161,7 @@ class Watchdog_Route(threading.Thread):
     def __init__(self, threadID, name, routingid):
         super(Watchdog_Route, self).__init__()
         if not routingid in wisglobals.watchdogRouteThreadQueue:
-            self.queue = Queue()
+            self.queue = SmsQueue()
             wisglobals.watchdogRouteThreadQueue[routingid] = self.queue
 
         wisglobals.watchdogRouteThread[routingid] = self
@@ -181,11 +202,93 @@ class Watchdog_Route(threading.Thread):
 
         smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(self.routingid) + "]: stopped")
 
+    @staticmethod
+    def addpending(smstrans, routingid):
+        with pendinglock:
+            previous = pendingsms.get(smstrans.smsdict["smsid"])
+            pendingsms[smstrans.smsdict["smsid"]] = {"sms": smstrans,
+                                                     "routingid": routingid,
+                                                     "time": datetime.utcnow()}
+            # a resent sms is only outstanding once
+            if previous is not None:
+                lbstrategy.done(previous["routingid"])
+            lbstrategy.sent(routingid)
+
+    @staticmethod
+    def poppending(smsid, status_code=None):
+        """Remove the pending sms and report the outcome of the send to
+        the load balancing, status_code None for a failed request
+        """
+        with pendinglock:
+            pending = pendingsms.pop(smsid, None)
+        if pending is not None:
+            seconds = (datetime.utcnow() - pending["time"]).total_seconds()
+            lbstrategy.observe(pending["routingid"], seconds, status_code == 1)
+        return pending
+
+    @staticmethod
+    def reprocess(smstrans):
+        try:
+            Helper.processsms(smstrans)
+        except apperror.NoRoutesFoundError:
+            pass
+        else:
+            # Add sms to global queue
+            wisglobals.watchdogThread.queue.put(smstrans.smsdict["smsid"], priority=smstrans.smsdict["priority"])
+            wisglobals.watchdogThreadNotify.set()
+
+    @staticmethod
+    def smsstatus(data):
+        """Status of an accepted sms reported back by PIS on /api/smsstatus
+        """
+        status_code = int(data["status_code"])
+        pending = Watchdog_Route.poppending(data["smsid"], status_code)
+        if pending is None:
+            smsgwglobals.wislogger.debug("WATCHDOG: status for unknown SMS " + str(data))
+            return False
+        Watchdog_Route.handlestatus(pending["sms"], status_code, pending["routingid"])
+        return True
+
+    @staticmethod
+    def handlestatus(smstrans, status_code, routingid):
+        smstrans.smsdict["statustime"] = datetime.utcnow()
+        if status_code == 1:
+            if smstrans.smsdict["status"] == -1:
+                smstrans.smsdict["status"] = 101
+                smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(routingid) + "] SEND deligated:" + str(smstrans.smsdict))
+            else:
+                smstrans.smsdict["status"] = 1
+                smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(routingid) + "] SEND direct:" + str(smstrans.smsdict))
+            smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(routingid) + "] SEND Update DB SUCCESS:" + str(smstrans.smsdict))
+            smstrans.updatedb()
+        elif status_code == 2000 or status_code == 31 or status_code == 27 or status_code == 69:
+            # PIS doesn't have modem endpoint - reprocess SMS and choose different route) - Error 2000
+            # Modem fail - reprocess SMS and choose different route) - Error 31 (can't read SMSC nummber, 99.99% - we just lost connection)
+            # Modem fail - reprocess SMS and choose different route) - Error 27 ( no money or SIM card blocked)
+            # Modem fail - reprocess SMS and choose different route) - Error 69 (can't read SMSC nummber, 99.99% - we just lost connection)
+            # BUT use same smsid (after new route will be choosed it will decrease sms_count on route (IMSI)
+            smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(routingid) + "] PIS can't reach PID: " + str(smstrans.smsdict))
+            Watchdog_Route.reprocess(smstrans)
+        else:
+            if smstrans.smsdict["status"] == 0:
+                smstrans.smsdict["status"] = status_code
+                smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(routingid) + "] SEND direct ERROR:" + str(smstrans.smsdict))
+            else:
+                smstrans.smsdict["status"] = 100 + status_code
+                smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(routingid) + "] SEND deligated ERROR:" + str(smstrans.smsdict))
+            smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(routingid) + "] SEND Update DB ERROR:" + str(smstrans.smsdict))
+            smstrans.updatedb()
+
     def send(self, sms):
         smstrans = sms["sms"]
         route = sms["route"]
+        smsid = smstrans.smsdict["smsid"]
+        # PIS accepts the sms at once and posts the status to statusurl,
+        # PIS without support ignores it and answers with the status
+        senddict = dict(smstrans.smsdict)
+        senddict["statusurl"] = route[0]["wisurl"] + "/api/smsstatus"
         # encode to json
-        jdata = json.dumps(smstrans.smsdict, default=str)
+        jdata = json.dumps(senddict, default=str)
         data = GlobalHelper.encodeAES(jdata)
 
         request = \
@@ -196,6 +299,8 @@ class Watchdog_Route(threading.Thread):
         request.add_header("Content-Type",
                            "application/json;charset=utf-8")
 
+        # pending before sending, the status may arrive before the reply
+        Watchdog_Route.addpending(smstrans, self.routingid)
         try:
             smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(self.routingid) + "] " +
                                          "Sending VIA " +
@@ -204,45 +309,15 @@ class Watchdog_Route(threading.Thread):
                                          "/sendsms")
             f = urllib.request.urlopen(request, data, timeout=wisglobals.pissendtimeout)
             smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(self.routingid) + "] SMS send to PIS returncode:" + str(f.getcode()))
-            # if all is OK set the sms status to SENT
-            smstrans.smsdict["statustime"] = datetime.utcnow()
-            if f.getcode() == 200:
+            if f.getcode() == 202:
+                smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(self.routingid) + "] SEND accepted, waiting for status:" + smsid)
+            elif f.getcode() == 200:
                 status_code = f.read()
-
-                if int(status_code) == 1:
-                    if smstrans.smsdict["status"] == -1:
-                        smstrans.smsdict["status"] = 101
-                        smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(self.routingid) + "] SEND deligated:" + str(smstrans.smsdict))
-                    else:
-                        smstrans.smsdict["status"] = 1
-                        smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(self.routingid) + "] SEND direct:" + str(smstrans.smsdict))
-                    smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(self.routingid) + "] SEND Update DB SUCCESS:" + str(smstrans.smsdict))
-                    smstrans.updatedb()
-                elif int(status_code) == 2000 or int(status_code) == 31 or int(status_code) == 27 or int(status_code) == 69:
-                    # PIS doesn't have modem endpoint - reprocess SMS and choose different route) - Error 2000
-                    # Modem fail - reprocess SMS and choose different route) - Error 31 (can't read SMSC nummber, 99.99% - we just lost connection)
-                    # Modem fail - reprocess SMS and choose different route) - Error 27 ( no money or SIM card blocked)
-                    # Modem fail - reprocess SMS and choose different route) - Error 69 (can't read SMSC nummber, 99.99% - we just lost connection)
-                    # BUT use same smsid (after new route will be choosed it will decrease sms_count on route (IMSI)
-                    smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(self.routingid) + "] PIS can't reach PID: " + str(smstrans.smsdict))
-                    try:
-                        Helper.processsms(smstrans)
-                    except apperror.NoRoutesFoundError:
-                        pass
-                    else:
-                        # Add sms to global queue
-                        wisglobals.watchdogThread.queue.put(smstrans.smsdict["smsid"])
-                        wisglobals.watchdogThreadNotify.set()
-                else:
-                    if smstrans.smsdict["status"] == 0:
-                        smstrans.smsdict["status"] = int(status_code)
-                        smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(self.routingid) + "] SEND direct ERROR:" + str(smstrans.smsdict))
-                    else:
-                        smstrans.smsdict["status"] = 100 + int(status_code)
-                        smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(self.routingid) + "] SEND deligated ERROR:" + str(smstrans.smsdict))
-                    smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(self.routingid) + "] SEND Update DB ERROR:" + str(smstrans.smsdict))
-                    smstrans.updatedb()
+                if Watchdog_Route.poppending(smsid, int(status_code)) is not None:
+                    Watchdog_Route.handlestatus(smstrans, int(status_code), self.routingid)
         except urllib.error.URLError as e:
+            if Watchdog_Route.poppending(smsid) is None:
+                return
             if smstrans.smsdict["status"] == -1:
                 smstrans.smsdict["status"] = 300
             else:
@@ -255,38 +330,30 @@ class Watchdog_Route(threading.Thread):
             smsgwglobals.wislogger.debug("WA3TCHDOG [route: " + str(self.routingid) + "] SEND Get peers NOTOK")
 
             # On 500 error - (probably PID/route died - try to reprocess sms)
-            try:
-                Helper.processsms(smstrans)
-            except apperror.NoRoutesFoundError:
-                pass
-            else:
-                # Add sms to global queue
-                wisglobals.watchdogThread.queue.put(smstrans.smsdict["smsid"])
-                wisglobals.watchdogThreadNotify.set()
+            Watchdog_Route.reprocess(smstrans)
         except socket.timeout as e:
+            if Watchdog_Route.poppending(smsid) is None:
+                return
             smstrans.smsdict["status"] = 400
             smstrans.updatedb()
             smsgwglobals.wislogger.debug(e)
             smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(self.routingid) + "] SEND Socket connection timeout")
 
             # On 400 error - (probably PID/route died - try to reprocess sms)
-            try:
-                Helper.processsms(smstrans)
-            except apperror.NoRoutesFoundError:
-                pass
-            else:
-                # Add sms to global queue
-                wisglobals.watchdogThread.queue.put(smstrans.smsdict["smsid"])
-                wisglobals.watchdogThreadNotify.set()
+            Watchdog_Route.reprocess(smstrans)
 
     def process(self, sms):
         smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(self.routingid) + "] processing sms")
 
-        # Each modem in any case will be sending SMS in sequantal mode. So sleep a bit
-        # Re run processing to make sure that queue empty
-        sleep_time = randrange(33,41)
-        sleep(sleep_time)
-        self.send(sms)
+        # Each modem in any case will be sending SMS in sequantal mode.
+        # Wait for the rate limit of the route, terminate interrupts it
+        bucket = ratelimit.getbucket(sms["route"][0])
+        if bucket.acquire(self.e):
+            self.send(sms)
+            return
+
+        smsgwglobals.wislogger.debug("WATCHDOG [route: " + str(self.routingid) + "] terminated while waiting, reprocess sms")
+        Watchdog_Route.reprocess(sms["sms"])
 
     def stop(self):
         self.e.set()
@@ -320,7 +387,7 @@ class Watchdog(threading.Thread):
             wd.start()
 
         queue = wisglobals.watchdogRouteThreadQueue[rid]
-        queue.put({ "sms" : smstrans, "route": route})
+        queue.put({ "sms" : smstrans, "route": route}, priority=smstrans.smsdict["priority"])
 
         wisglobals.watchdogRouteThreadNotify[rid].set()
 
@@ -366,19 +433,43 @@ class Watchdog(threading.Thread):
             smsgwglobals.wislogger.debug(e)
             smsgwglobals.wislogger.debug("WATCHDOG: DELIGATE socket connection timeout " + str(smstrans.smsdict))
 
-    def process(self, sms_id):
+    def process(self, item):
+        # the api queues the routed Smstransfer, recovery paths the smsid
+        if isinstance(item, Smstransfer):
+            self.process_sms(item)
+        else:
+            self.process_smsid(item)
+
+    def process_sms(self, smstrans):
+        smsgwglobals.wislogger.debug("WATCHDOG: Process SMS: " + str(smstrans.smsdict))
+        # the route taken while routing is still valid as long as the
+        # routing snapshot did not change
+        if smstrans.routingversion is not None and \
+                smstrans.routingversion == wisglobals.rdb.read_snapshot_version():
+            route = list(smstrans.route)
+        else:
+            route = wisglobals.rdb.read_routing(smstrans.smsdict["modemid"])
+        self.process_route(smstrans, route)
+
+    def process_smsid(self, sms_id):
 
         try:
             db = database.Database()
             smsen = db.read_sms(smsid=sms_id)
+            if not smsen and database.writebehind is not None:
+                # the sms may still wait in the write-behind queue
+                db.flush()
+                smsen = db.read_sms(smsid=sms_id)
             if not smsen:
                 smsgwglobals.wislogger.debug("WATCHDOG: no SMS with ID: " + sms_id + " in DB")
                 # Add sms_id back to the queue
                 self.queue.put(sms_id)
+                return
         except error.DatabaseError as e:
             smsgwglobals.wislogger.debug(e.message)
             # Add sms_id back to the queue
             self.queue.put(sms_id)
+            return
 
         # we have sms, just process
         sms = smsen[0]
@@ -387,7 +478,9 @@ class Watchdog(threading.Thread):
         # create smstrans object for easy handling
         smstrans = Smstransfer(**sms)
         route = wisglobals.rdb.read_routing(smstrans.smsdict["modemid"])
+        self.process_route(smstrans, route)
 
+    def process_route(self, smstrans, route):
         if route is None or len(route) == 0:
             smsgwglobals.wislogger.debug("WATCHDOG: ALERT ROUTE LOST")
             # try to reprocess route
@@ -397,7 +490,7 @@ class Watchdog(threading.Thread):
             except apperror.NoRoutesFoundError:
                 pass
             else:
-                self.queue.put(smstrans.smsdict["smsid"])
+                self.queue.put(smstrans.smsdict["smsid"], priority=smstrans.smsdict["priority"])
         elif route[0]["wisid"] != wisglobals.wisid:
             self.deligate(smstrans, route)
         else:
@@ -407,7 +500,7 @@ class Watchdog(threading.Thread):
             # this may lead to an error, fixme
             route[:] = [d for d in route if d['obsolete'] < 1]
             smsgwglobals.wislogger.debug("WATCHDOG: process with route %s ", str(route))
-            smsgwglobals.wislogger.debug("WATCHDOG: Sending to PIS %s", str(sms))
+            smsgwglobals.wislogger.debug("WATCHDOG: Sending to PIS %s", str(smstrans.smsdict))
             # only continue if route contains data
             if len(route) > 0:
                 self.dispatch_sms(smstrans, route)
@@ -419,7 +512,7 @@ class Watchdog(threading.Thread):
                 except apperror.NoRoutesFoundError:
                     pass
                 else:
-                    self.queue.put(smstrans.smsdict["smsid"])
+                    self.queue.put(smstrans.smsdict["smsid"], priority=smstrans.smsdict["priority"])
 
     def run(self):
         smsgwglobals.wislogger.debug("WATCHDOG: starting")
@@ -433,10 +526,10 @@ class Watchdog(threading.Thread):
             # processing sms in database
             try:
                 while True:
-                    sms_id = self.queue.get(block=False)
+                    item = self.queue.get(block=False)
                     try:
                         smsgwglobals.wislogger.debug("WATCHDOG: start processing sms")
-                        self.process(sms_id)
+                        self.process(item)
                     except Exception as e:
                         pass  # just try again to do stuff
                     else:
@@ -27,11 +27,24 @@ rdb = None
 cleanupseconds = None
 
 wisid = None
+# new with every start, peers send the whole routing table on a change
+bootid = None
 wisport = None
 wisipaddress = None
 
 pissendtimeout = None
 
+# default sending rate per route
+smsperminute = None
+smsburst = None
+smsjitter = None
+
+smsstatustimeout = None
+
+lbstrategy = None
+routingfullsync = None
+peerworkers = None
+
 ldapenabled = None
 ldapserver = None
 ldapbasedn = None
@@ -45,4 +58,12 @@ sslcertificatechain = None
 validusernameregex = None
 validusernamelength = None
 
+allowedmobileprefixes = None
+mobilevalidator = None
+uploadchunk = None
+
+ingestionworkers = None
+ingestionqueuesize = None
+ingestion = None
+
 version = None
@@ -20,9 +20,7 @@ import os
 import sys
 import re
 import uuid
-from queue import Queue
 import urllib.request
-import threading
 from datetime import datetime
 
 from pathlib import Path
@@ -38,11 +36,17 @@ from common.filelogger import FileLogger
 from application.helper import Helper
 from application import root
 from application.smstransfer import Smstransfer
-from application.watchdog import Watchdog, Watchdog_Scheduler
+from application.watchdog import Watchdog, Watchdog_Route, Watchdog_Scheduler
 from application.router import Router
 from application.stats import Logstash
 from application import wisglobals
-from application import apperror
+from application import ratelimit
+from application import lbstrategy
+from application import peerclient
+from application.validator import MobileValidator
+from application import upload
+from application.ingestion import IngestionExecutor
+from application.smsqueue import SmsQueue
 from application import routingdb
 
 from ldap3 import Server, Connection, ALL
@@ -204,6 +208,14 @@ class Root(object):
             else:
                 status['watchdog'] = 'dead'
 
+            if wisglobals.ingestion is not None:
+                status['ingestion'] = wisglobals.ingestion.stats()
+            if SMS_QUEUE is not None:
+                status['smsqueue'] = SMS_QUEUE.qsize()
+                status['smsqueuepriorities'] = SMS_QUEUE.depths()
+            status['routequeues'] = dict([(routingid, queue.depths()) for routingid, queue
+                                          in list(wisglobals.watchdogRouteThreadQueue.items())])
+
             data = json.dumps(status)
             return data
 
@@ -263,11 +275,23 @@ class Root(object):
                 cherrypy.response.status = 400
 
         if arg == "receiverouting":
+            # an empty table wants the whole one at once
+            empty = wisglobals.rdb.is_empty()
             try:
-                wisglobals.rdb.merge_routing(data)
+                # changed entries only or with liveness of the others
+                if isinstance(data, dict):
+                    wisglobals.rdb.merge_routing(data.get("routes", []))
+                    wisglobals.rdb.merge_alive(data.get("alive", {}))
+                else:
+                    wisglobals.rdb.merge_routing(data)
             except error.DatabaseError as e:
                 smsgwglobals.wislogger.debug(e.message)
 
+            # older WIS answer with an empty body, see Helper.sendrouting
+            return GlobalHelper.encodeAES(json.dumps({"alive": True,
+                                                      "bootid": wisglobals.bootid,
+                                                      "fullsync": empty}))
+
         if arg == "requestrouting":
             if data["get"] != "peers":
                 cherrypy.response.status = 400
@@ -307,6 +331,8 @@ class Root(object):
                         wisglobals.watchdogRouteThread.pop(routingid)
                         wisglobals.watchdogRouteThreadNotify.pop(routingid)
                         wisglobals.watchdogRouteThreadQueue.pop(routingid)
+                    ratelimit.removebucket(routingid)
+                    lbstrategy.forget(routingid)
 
                     Helper.receiverouting()
                 else:
@@ -314,6 +340,14 @@ class Root(object):
             except error.DatabaseError as e:
                 smsgwglobals.wislogger.debug(e.message)
 
+        if arg == "smsstatus":
+            # status of an sms accepted by PIS
+            if "smsid" in data and "status_code" in data:
+                if not Watchdog_Route.smsstatus(data):
+                    cherrypy.response.status = 404
+            else:
+                cherrypy.response.status = 400
+
         if arg == "deligatesms":
             if "sms" in data:
                 smsgwglobals.wislogger.debug(data["sms"])
@@ -473,27 +507,7 @@ class Root(object):
             mobile_numbers = json_data.get('mobile')
 
         initial_count = len(mobile_numbers)
-        mobile_numbers_to_send = []
-
-        invalid_messages = []
-        for targetnr in mobile_numbers:
-            digits_regex = '^\d{12}$'
-            digits_match = re.search(digits_regex, targetnr)
-            if digits_match is None:
-                msg = ":mobile number '" + targetnr + "' not valid. Should be 12 digits!"
-                invalid_messages.append(msg)
-            else:
-                allowed_prefix = False
-                for prefix in wisglobals.allowedmobileprefixes:
-                    prefix_regex = '^' + prefix + r'\d{7}$'
-                    prefix_match = re.search(prefix_regex, targetnr)
-                    if prefix_match is not None:
-                        allowed_prefix = True
-                if not allowed_prefix:
-                    msg = ":mobile number '" + targetnr + "' not valid. Allowed prefixes: " + str(wisglobals.allowedmobileprefixes)
-                    invalid_messages.append(msg)
-                else:
-                    mobile_numbers_to_send.append(targetnr)
+        mobile_numbers_to_send, invalid_messages = wisglobals.mobilevalidator.validate(mobile_numbers)
 
         # All our numbers invalid
         if initial_count == len(invalid_messages):
@@ -503,13 +517,22 @@ class Root(object):
             return resp
 
         priority = 1
-        if 'priority' in cherrypy.request.params:
-            priority = int(json.get('priority'))
+        if json_data.get('priority') is not None:
+            try:
+                priority = SmsQueue.clamp(json_data.get('priority'))
+            except (TypeError, ValueError):
+                cherrypy.response.status = 400
+                resp["message"] = ":priority attribute not a number"
+                return resp
 
         sourceip=cherrypy.request.headers.get('Remote-Addr'),
         xforwardedfor=cherrypy.request.headers.get('X-Forwarded-For'),
-        thread_sender = threading.Thread(target=self.thread_sender, args=[mobile_numbers_to_send, json_data, priority, sourceip, xforwardedfor])
-        thread_sender.start()
+        if not wisglobals.ingestion.submit(self.thread_sender, mobile_numbers_to_send, json_data, priority, sourceip, xforwardedfor):
+            smsgwglobals.wislogger.debug("WIS: sendsms ingestion queue full")
+            cherrypy.response.status = 503
+            cherrypy.response.headers['Retry-After'] = '1'
+            resp["message"] = ":ingestion queue full, try again later"
+            return resp
 
         cherrypy.response.status = 200
         final_count = len(mobile_numbers_to_send)
@@ -522,12 +545,109 @@ class Root(object):
 
         return resp
 
+    @cherrypy.expose
+    @cherrypy.tools.allow(methods=['POST'])
+    @cherrypy.tools.json_out()
+    @cherrypy.config(**{'request.process_request_body': False})
+    def sendsmsstream(self, **params):
+        """Streaming upload of recipients, NDJSON (default) or CSV
+        with Content-Type text/csv. content, appid and priority are
+        query parameters, rows may override content and appid.
+        The body is routed and stored in chunks while it is read.
+        """
+        params = dict([(x[0].lower(), x[1]) for x in params.items()])
+        try:
+            priority = SmsQueue.clamp(params.get("priority", 1))
+        except ValueError:
+            cherrypy.response.status = 400
+            return {"message": ":priority attribute not a number"}
+        sourceip = cherrypy.request.headers.get('Remote-Addr')
+        xforwardedfor = cherrypy.request.headers.get('X-Forwarded-For')
+        campaignid = str(uuid.uuid1())
+        # shared values of the campaign, rows may override them
+        campaign = Helper.campaign(campaignid,
+                                   Smstransfer(content=params.get("content"),
+                                               targetnr="",
+                                               priority=priority,
+                                               appid=params.get("appid"),
+                                               sourceip=sourceip,
+                                               xforwardedfor=xforwardedfor))
+
+        rows = upload.readrows(cherrypy.request.body,
+                               cherrypy.request.headers.get('Content-Type'))
+
+        accepted = 0
+        notqueued = 0
+        invalid_messages = []
+        invalid_count = 0
+        for chunk in upload.chunks(rows, wisglobals.uploadchunk):
+            numbers = [str(row.get("mobile")) for row in chunk if row.get("mobile")]
+            valid = set(wisglobals.mobilevalidator.validate(numbers)[0])
+
+            smslist = []
+            for row in chunk:
+                content = row.get("content") or params.get("content")
+                msg = None
+                if "error" in row:
+                    msg = row["error"]
+                elif not row.get("mobile"):
+                    msg = ":mobile attribute not set"
+                elif str(row["mobile"]) not in valid:
+                    msg = ":mobile number '" + str(row["mobile"]) + "' not valid"
+                elif not content:
+                    msg = ":content attribute not set for '" + str(row["mobile"]) + "'"
+                if msg is not None:
+                    invalid_count += 1
+                    if len(invalid_messages) < 100:
+                        invalid_messages.append(msg)
+                    continue
+
+                sms = Smstransfer(content=content,
+                                  targetnr=str(row["mobile"]),
+                                  priority=priority,
+                                  appid=row.get("appid") or params.get("appid"),
+                                  sourceip=sourceip,
+                                  xforwardedfor=xforwardedfor,
+                                  smsid=str(uuid.uuid1()))
+                smslist.append(sms)
+
+            if smslist:
+                # route and store this chunk before reading the next one
+                routed = Helper.processsms_bulk(smslist, campaign)
+                for sms in routed:
+                    SMS_QUEUE.put(sms, priority=priority)
+                # no route or not stored at all
+                accepted += len(routed)
+                notqueued += len(smslist) - len(routed)
+                self.triggerwatchdog()
+
+        smsgwglobals.wislogger.debug("WIS: sendsmsstream campaign " + campaignid +
+                                     " " + str(accepted) + " sms, " +
+                                     str(notqueued) + " not queued, " +
+                                     str(invalid_count) + " invalid")
+
+        resp = {}
+        resp["campaignid"] = campaignid
+        resp["accepted"] = accepted
+        resp["rejected"] = invalid_count
+        resp["notqueued"] = notqueued
+        if accepted == 0:
+            cherrypy.response.status = 422
+        message = ":" + str(accepted) + " sms added to the queue successfully"
+        if notqueued:
+            message += ", :" + str(notqueued) + " sms not queued"
+        if invalid_messages:
+            message += ", " + ", ".join(invalid_messages)
+        resp["message"] = message
+        return resp
+
     def thread_sender(self, mobile_numbers_to_send, json_data, priority, sourceip, xforwardedfor):
         if isinstance(sourceip, tuple):
             sourceip = str(sourceip[0])
         if isinstance(xforwardedfor, tuple):
             xforwardedfor = str(xforwardedfor[0])
 
+        smslist = []
         for targetnr in mobile_numbers_to_send:
             # this is used for parameter extraction
             # Create sms data object and make sure that it has a smsid
@@ -539,20 +659,22 @@ class Root(object):
                               sourceip=sourceip,
                               xforwardedfor=xforwardedfor,
                               smsid=sms_uuid)
+            smslist.append(sms)
 
-            smsgwglobals.wislogger.debug("WIS: sendsms interface " + str(sms.getjson()))
+        smsgwglobals.wislogger.debug("WIS: sendsms interface " +
+                                     str(len(smslist)) + " sms")
 
-            # process sms to insert it into database
-            try:
-                Helper.processsms(sms)
-                smsid = sms.smstransfer["sms"]["smsid"]
-                SMS_QUEUE.put(smsid)
-            except apperror.NoRoutesFoundError:
-                self.triggerwatchdog()
-                pass
-            except apperror.NotAllowedTimeFrame:
-                self.triggerwatchdog()
-                pass
+        # identical content for many numbers is stored once
+        campaign = None
+        if len(smslist) > 1:
+            campaign = Helper.campaign(str(uuid.uuid1()), smslist[0])
+
+        # route the whole list at once and insert it into database
+        routed = Helper.processsms_bulk(smslist, campaign)
+        for sms in routed:
+            SMS_QUEUE.put(sms, priority=priority)
+
+        self.triggerwatchdog()
 
 
 class Wisserver(object):
@@ -578,6 +700,7 @@ class Wisserver(object):
         smsgwglobals.wislogger.debug("WIS: Version: " + str(wisglobals.version))
 
         wisglobals.wisid = cfg.getvalue('wisid', 'nowisid', 'wis')
+        wisglobals.bootid = str(uuid.uuid1())
         wisglobals.wisipaddress = cfg.getvalue('ipaddress', '127.0.0.1', 'wis')
         wisglobals.wisport = cfg.getvalue('port', '7777', 'wis')
         wisglobals.cleanupseconds = cfg.getvalue('cleanupseconds', '315569520', 'wis')
@@ -606,9 +729,37 @@ class Wisserver(object):
         # read pissendtimeout
         wisglobals.pissendtimeout = int(cfg.getvalue('pissendtimeout', '20', 'wis'))
 
+        # default sending rate per route if the carrier has none configured
+        wisglobals.smsperminute = float(cfg.getvalue('smsperminute', '1.7', 'wis'))
+        wisglobals.smsburst = int(cfg.getvalue('smsburst', '1', 'wis'))
+        wisglobals.smsjitter = float(cfg.getvalue('smsjitter', '4', 'wis'))
+
+        # route selection: leastload, wrr, outstanding or ewma
+        wisglobals.lbstrategy = cfg.getvalue('lbstrategy', 'leastload', 'wis')
+
+        # seconds between full routing table sends to a peer, changed
+        # entries are sent in between
+        wisglobals.routingfullsync = int(cfg.getvalue('routingfullsync', '300', 'wis'))
+
+        # parallel requests and kept alive connections to other wis
+        wisglobals.peerworkers = int(cfg.getvalue('peerworkers', '8', 'wis'))
+
+        # seconds to wait for the status of an sms accepted by PIS
+        wisglobals.smsstatustimeout = int(cfg.getvalue('smsstatustimeout', '300', 'wis'))
+
         # Read allowed mobile prefixes to process
         mobile_prefixes_raw = cfg.getvalue('allowedmobileprefixes', '.*', 'wis').split(",")
         wisglobals.allowedmobileprefixes = set(sorted([ d.strip() for d in mobile_prefixes_raw if d != ""]))
+        wisglobals.mobilevalidator = MobileValidator(wisglobals.allowedmobileprefixes)
+
+        # recipients routed at once by /sendsmsstream
+        wisglobals.uploadchunk = int(cfg.getvalue('uploadchunk', '1000', 'wis'))
+
+        # workers and queue depth for /sendsms, full queue answers 503
+        wisglobals.ingestionworkers = int(cfg.getvalue('ingestionworkers', '4', 'wis'))
+        wisglobals.ingestionqueuesize = int(cfg.getvalue('ingestionqueuesize', '200', 'wis'))
+        wisglobals.ingestion = IngestionExecutor(wisglobals.ingestionworkers,
+                                                 wisglobals.ingestionqueuesize)
 
         # Read allowed timeframe for sending start/finish time
         wisglobals.allowedstarttime = cfg.getvalue('allowedstarttime', '01:00', 'wis')
@@ -651,6 +802,11 @@ class Wisserver(object):
         # Start scheduler for sms resending and other maintenance operations
         Watchdog_Scheduler()
 
+        # Commit deferred sms writes before the engine goes down
+        cherrypy.engine.subscribe('stop', wisglobals.ingestion.shutdown, priority=40)
+        cherrypy.engine.subscribe('stop', db.shutdown)
+        cherrypy.engine.subscribe('stop', peerclient.shutdown)
+
         config_file = os.path.join(Path(__file__).resolve().parents[0], 'wis-web.conf')
         cherrypy.quickstart(Root(), '/', config_file)
 
@@ -699,12 +855,10 @@ def main(argv):
 
     # Create the routingdb
     wisglobals.rdb = routingdb.Database()
-    wisglobals.rdb.create_table_routing()
-    wisglobals.rdb.read_routing()
 
     # Create message queue
     global SMS_QUEUE
-    SMS_QUEUE = Queue()
+    SMS_QUEUE = SmsQueue()
 
     # Start the router
     rt = Router(2, "Router")